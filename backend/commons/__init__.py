@@ -1,4 +1,5 @@
 from .logger import configure_logger
-from .database import engine, SessionLocal, Base, db_dependency
+from .database import engine, SessionLocal, async_engine, AsyncSessionLocal, Base, db_dependency, add_missing_columns
+from .cache import LRUCache
 
 backend_log = configure_logger()
\ No newline at end of file
@@ -1,18 +1,45 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from contextlib import asynccontextmanager
 from schema import *
 
 import os
 import uuid
-import shutil
+import json
+import asyncio
+
+from utils import document, chat, ingestion
+from utils.vector_index import ensure_vector_index
+from utils.retriever import retrieval_cache
+from commons import db_dependency, Base, engine, add_missing_columns, AsyncSessionLocal, backend_log
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+
+    # compile every (model, persona) chain before serving traffic
+    chat.chain_registry.warm()
+
+    # bring existing vector tables up to date (ANN index, full text column)
+    async with AsyncSessionLocal() as db:
+        await ensure_vector_index(db)
+
+    yield
+
+    # stop document parse workers
+    document.parse_pool.shutdown(cancel_futures=True)
+
+    # release shared LLM connection pools
+    chat.http_client.close()
+    await chat.http_async_client.aclose()
 
-from utils import document, chat
-from commons import db_dependency, Base, engine, backend_log
 
 # initiate App
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Create Tables in PostgresDB if they already dont exist
 Base.metadata.create_all(bind=engine)
+add_missing_columns()
 
 
 
@@ -29,13 +56,29 @@ def get_model_names():
 def get_persona():
     return [persona.value for persona in ModelPersona]
 
+@app.get("/model/chain/stats", response_model=ChainRegistryStats)
+def get_chain_stats():
+    return chat.chain_registry.stats()
+
+@app.get("/model/contextualize/stats", response_model=ContextualizerStats)
+def get_contextualize_stats():
+    return chat.contextualizer.stats()
+
+@app.get("/conversation/cache/stats", response_model=AnswerCacheStats)
+async def get_answer_cache_stats():
+    return await chat.answer_cache.stats()
+
+@app.get("/conversation/retrieval_cache/stats", response_model=RetrievalCacheStats)
+def get_retrieval_cache_stats(embedding_model: EmbeddingModelName | None = None):
+    return RetrievalCacheStats(query_embeddings=document.get_embedder(embedding_model).query_cache.stats(), results=retrieval_cache.stats())
+
 
 
 
 
 
 @app.post("/conversation", response_model=QueryResponse)
-def conversation(request: QueryInput, db : db_dependency):
+async def conversation(request: QueryInput, db : db_dependency, background_tasks: BackgroundTasks):
     
     backend_log.info(f"Request intercepted : Session ID: {request.session_id}, User Query: {request.question}, Model: {request.model}")
     
@@ -47,14 +90,14 @@ def conversation(request: QueryInput, db : db_dependency):
         # New session 
         session_id = str(uuid.uuid4())
 
-    # can be an empty list
-    chat_history: list = chat.fetch_history(session_id, db)
-    rag_chain = chat.get_rag_chain(request.model)
+    # can be an empty list, bounded by the model's history token budget
+    chat_history: list = await chat.fetch_history(session_id, db, request.model)
+    doc_ids: list[int] = await chat.resolve_context(session_id, request.doc_ids, db)
+
+    # filled in by the rag pipeline
+    trace = RetrievalTrace()
 
-    answer = rag_chain.invoke({
-        "input": request.question,
-        "chat_history": chat_history
-    })['answer']
+    answer = "".join([token async for token in chat.astream_answer(request, chat_history, doc_ids, trace)])
     
 
     chat_history = ChatHistory(
@@ -68,9 +111,64 @@ def conversation(request: QueryInput, db : db_dependency):
     backend_log.info(f'Session: {session_id} | AI Response {answer}')
  
     # Update chat history in DB
-    chat.update_history(chat_history, db)
+    await chat.update_history(chat_history, db)
+
+    # fold older turns into the session summary once the response is sent
+    background_tasks.add_task(chat.fold_history, session_id)
        
-    return QueryResponse(answer=answer, session_id=session_id)
+    return QueryResponse(answer=answer, session_id=session_id, trace=trace)
+
+
+
+# format a single server sent event
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/conversation/stream")
+async def conversation_stream(request: QueryInput, db: db_dependency):
+
+    backend_log.info(f"Stream request intercepted : Session ID: {request.session_id}, User Query: {request.question}, Model: {request.model}")
+
+    session_id: str = request.session_id or str(uuid.uuid4())
+
+    # history is read before streaming starts, request scoped session is still open here
+    chat_history: list = await chat.fetch_history(session_id, db, request.model)
+    doc_ids: list[int] = await chat.resolve_context(session_id, request.doc_ids, db)
+
+    async def token_stream():
+
+        tokens = []
+        trace = RetrievalTrace()
+
+        try:
+            async for token in chat.astream_answer(request, chat_history, doc_ids, trace):
+                if token:
+                    tokens.append(token)
+                    yield sse_event("token", {"token": token})
+
+        except Exception as e:
+            backend_log.info(f'Session: {session_id} | Exception while streaming response : {e}')
+            yield sse_event("error", {"detail": str(e)})
+            return
+
+        answer = "".join(tokens)
+        backend_log.info(f'Session: {session_id} | AI Response {answer}')
+
+        # stream has ended, persist the full turn with its own session
+        async with AsyncSessionLocal() as stream_db:
+            await chat.update_history(ChatHistory(
+                session_id = session_id,
+                question = request.question,
+                response = answer,
+                model = request.model,
+                persona = request.persona
+            ), stream_db)
+
+        yield sse_event("done", {"session_id": session_id, "trace": trace.model_dump()})
+
+    # summary fold runs after the stream (and its history write) has finished
+    return StreamingResponse(token_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}, background=BackgroundTask(chat.fold_history, session_id))
 
 
 
@@ -79,30 +177,58 @@ def conversation(request: QueryInput, db : db_dependency):
 @app.post("/document/upload")
 async def upload_document(db: db_dependency, file: UploadFile = File(...), ):
 
-    allowed_extensions = ['.pdf', '.docx',]
-    file_extension = os.path.splitext(file.filename)[1].lower()
-    
-    # File type validation
-    if file_extension not in allowed_extensions:
-        raise HTTPException(status_code=400, detail=f"Unsupported file type. Allowed types are: {', '.join(allowed_extensions)}")
-    
-    # File path validation
-    file_storage_path = f"library/{file.filename}"
-    if os.path.exists(file_storage_path):
-        raise HTTPException(status_code=400, detail=f"File With Same Name {file.filename}, Already present in library !")
-
-    # Save the uploaded file to a directory
-    with open(file_storage_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    # record document in DB
-    saved_doc = await document.insert_in_library(file.filename, db)
-    
-    # success = index_document_to_chroma(temp_file_path, file_id)
-    
-    if os.path.exists(file_storage_path):
-        return {"message": f"File {file.filename} has been successfully uploaded with id : {saved_doc.id }"}
+    # validate and stream the upload to a temporary file of the library, deduplicated by content hash
+    item, staged = await document.stage_upload(file, db)
+
+    if not item.success:
+        raise HTTPException(status_code=item.status_code, detail=item.message)
+
+    # same content uploaded before (under any name), nothing to store or ingest
+    if item.duplicate:
+        return {"message": f"{item.message} with id : {item.id}", "id": item.id, "duplicate": True}
+
+    # move file in place and record document in DB
+    saved_docs = await document.publish_uploads([(item, *staged)], db)
+
+    # a concurrent upload of the same content was recorded first
+    if item.duplicate:
+        return {"message": f"{item.message} with id : {item.id}", "id": item.id, "duplicate": True}
+
+    saved_doc = saved_docs[0]
+
+    # parse, split and embed right away in the ingestion workers, a later build context only activates it
+    job = await ingestion.enqueue([saved_doc.id], None, db)
+
+    return {"message": item.message, "id": saved_doc.id, "job_id": job.id}
+
+
+#? ------------------------------BULK UPLOAD DOCUMENTS-------------------------#
+@app.post("/document/upload/batch", response_model=DocBulkUploadResponse)
+async def upload_documents(db: db_dependency, files: list[UploadFile] = File(...), ):
+
+    items = []
+    staged = []
+    batch = {}   # content hash -> file name, catches duplicates within the request
+
+    for file in files:
+        item, new = await document.stage_upload(file, db, batch)
+        items.append(item)
+        if new:
+            staged.append((item, *new))
+
+    if not staged:
+        return DocBulkUploadResponse(items=items)
+
+    # every accepted file is recorded in one transaction and ingested by one job
+    saved_docs = await document.publish_uploads(staged, db)
+
+    # every file may have been recorded first by a concurrent upload of the same content
+    if not saved_docs:
+        return DocBulkUploadResponse(items=items)
 
+    job = await ingestion.enqueue([doc.id for doc in saved_docs], None, db)
+
+    return DocBulkUploadResponse(items=items, job_id=job.id)
 
         
 
@@ -112,6 +238,12 @@ async def list_documents(db:db_dependency):
     return await document.list_all(db)
 
 
+#* ---------------- EMBEDDING CACHE STATS ---------------------------------#
+@app.get("/document/embedding_cache/stats", response_model=EmbeddingCacheStats)
+async def embedding_cache_stats(embedding_model: EmbeddingModelName | None = None):
+    return await document.get_embedder(embedding_model).stats()
+
+
 #! ---------------- DELETE DOCUMENT ---------------------------------#
 @app.post("/document/delete")
 async def delete_document(request: DocDeleteRequest, db: db_dependency):
@@ -140,6 +272,22 @@ async def delete_document(request: DocDeleteRequest, db: db_dependency):
     return response
 
 
+#! ---------------- BULK DELETE DOCUMENTS ---------------------------------#
+@app.post("/document/delete/batch", response_model=DocBulkDeleteResponse)
+async def delete_documents(request: DocBulkDeleteRequest, db: db_dependency):
+
+    # records and vectors of every deletable document go in one transaction
+    items = await document.delete_many_from_library(request.ids, db)
+
+    # then remove files from disk
+    for item in items:
+        filepath = f'library/{item.filename}'
+        if item.success and os.path.exists(filepath):
+            await asyncio.to_thread(os.remove, filepath)
+
+    return DocBulkDeleteResponse(items=items)
+
+
 
 
 
@@ -156,9 +304,18 @@ async def build_context(request: DocContextRequest, db: db_dependency) -> DocCon
         
         backend_log.info(f"Docs were activated in DB !")
 
-        embedding_process: DocEmbedResponse = await document.embed(db)
+        # documents ingested at upload (or by an earlier build) only needed the activation
+        collection = document.collection_name(request.embedding_model)
+        embedded_ids = await document.fetch_embedded_doc_ids(db, collection)
+        missing_ids = [doc_id for doc_id in request.ids if doc_id not in embedded_ids]
 
-        response = DocContextResponse(success=embedding_process.success, message=embedding_process.message)
+        if not missing_ids:
+            return DocContextResponse(success=True, message=f"Context updated : {len(request.ids)} documents already embedded")
+
+        # parsing and embedding run in the ingestion workers, progress is polled from the job status
+        job = await ingestion.enqueue(missing_ids, request.embedding_model, db)
+
+        response = DocContextResponse(success=True, message=f"Context build queued as job {job.id}", job_id=job.id)
 
     else:
         raise HTTPException(status_code=400, detail=f"{activation.message}")
@@ -166,4 +323,15 @@ async def build_context(request: DocContextRequest, db: db_dependency) -> DocCon
     return response
 
 
+@app.get("/document/build_context/{job_id}", response_model=IngestionJobStatus)
+async def build_context_status(job_id: int, db: db_dependency):
+
+    status = await ingestion.job_status(job_id, db)
+
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Ingestion job {job_id} not found")
+
+    return status
+
+
 
@@ -1,3 +1,9 @@
 from commons import Base
 from .document import Document
-from .chat import Chat
\ No newline at end of file
+from .chat import Chat
+from .chat_summary import ChatSummary
+from .embedding_cache import EmbeddingCache
+from .session_context import SessionContext
+from .context_version import ContextVersion
+from .answer_cache import AnswerCache
+from .ingestion_job import IngestionJob, IngestionJobDocument
\ No newline at end of file
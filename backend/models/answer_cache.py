@@ -0,0 +1,28 @@
+from sqlalchemy import Integer, String, DateTime, Text, Index, func
+from sqlalchemy.orm import Mapped, mapped_column
+from pgvector.sqlalchemy import Vector
+from datetime import datetime
+
+from models import Base
+
+
+class AnswerCache(Base):
+    __tablename__ = 'answer_cache'
+
+    id : Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    model : Mapped[str] = mapped_column(String(100), nullable=False)
+    persona : Mapped[str] = mapped_column(String(100), nullable=False)
+    context_version : Mapped[int] = mapped_column(Integer, nullable=False)
+    doc_set_hash : Mapped[str] = mapped_column(String(64), nullable=False)
+    question : Mapped[str] = mapped_column(Text, nullable=False)
+    embedding = mapped_column(Vector(), nullable=False)
+    answer : Mapped[str] = mapped_column(Text, nullable=False)
+    hits : Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    created_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,server_default=func.now())
+    last_hit_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,index=True,server_default=func.now())
+
+    # lookups scan only the (small) partition of one model, persona and document set
+    __table_args__ = (
+        Index('answer_cache_key_idx', 'model', 'persona', 'context_version', 'doc_set_hash'),
+    )
+
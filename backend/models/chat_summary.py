@@ -0,0 +1,15 @@
+from sqlalchemy import Integer, String, DateTime, Text, func
+from sqlalchemy.orm import Mapped, mapped_column
+from datetime import datetime
+
+from models import Base
+
+
+class ChatSummary(Base):
+    __tablename__ = 'history_summary'
+
+    session_id : Mapped[str] = mapped_column(String(100), primary_key=True)
+    summary : Mapped[str] = mapped_column(Text, nullable=False)
+    summarized_upto : Mapped[int] = mapped_column(Integer, nullable=False)   # last history.id folded into summary
+    updated_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,server_default=func.now(),onupdate=func.now())
+
@@ -0,0 +1,15 @@
+from sqlalchemy import Integer, DateTime, func
+from sqlalchemy.orm import Mapped, mapped_column
+from datetime import datetime
+
+from models import Base
+
+
+# single row, bumped every time the embedded context changes
+class ContextVersion(Base):
+    __tablename__ = 'context_version'
+
+    id : Mapped[int] = mapped_column(Integer, primary_key=True, default=1)
+    version : Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    updated_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,server_default=func.now(),onupdate=func.now())
+
@@ -1,4 +1,4 @@
-from sqlalchemy import Integer, String, DateTime, ForeignKey, Boolean, func
+from sqlalchemy import Integer, String, DateTime, ForeignKey, Boolean, Index, text, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
 from datetime import datetime
 
@@ -11,5 +11,12 @@ class Document(Base):
     id : Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     name : Mapped[str] = mapped_column(String(100), nullable=False)
     is_active: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+    ingestion_state: Mapped[str] = mapped_column(String(20), default="pending", server_default="pending", nullable=False)  # pending | parsed | embedded | failed
+    chunk_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
+    content_hash: Mapped[str | None] = mapped_column(String(64), nullable=True)  # sha256 of the file, NULL for files uploaded before hashing
     uploaded_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,index=True,server_default=func.now())
 
+    # uploads are deduplicated by content, concurrent uploads of the same file can't both be recorded
+    __table_args__ = (
+        Index('ux_library_content_hash', 'content_hash', unique=True, postgresql_where=text('content_hash IS NOT NULL')),
+    )
@@ -0,0 +1,17 @@
+from sqlalchemy import String, DateTime, func
+from sqlalchemy.orm import Mapped, mapped_column
+from pgvector.sqlalchemy import Vector
+from datetime import datetime
+
+from models import Base
+
+
+class EmbeddingCache(Base):
+    __tablename__ = 'embedding_cache'
+
+    model : Mapped[str] = mapped_column(String(100), primary_key=True)
+    content_hash : Mapped[str] = mapped_column(String(64), primary_key=True)
+    embedding = mapped_column(Vector(), nullable=False)
+    created_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,server_default=func.now())
+    last_used_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,index=True,server_default=func.now())
+
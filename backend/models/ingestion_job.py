@@ -0,0 +1,36 @@
+from sqlalchemy import Integer, String, DateTime, Float, Text, ForeignKey, func
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import Mapped, mapped_column
+from datetime import datetime
+
+from models import Base
+
+
+class IngestionJob(Base):
+    __tablename__ = 'ingestion_job'
+
+    id : Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    status : Mapped[str] = mapped_column(String(20), nullable=False, index=True, default="queued")  # queued | running | done | failed
+    embedding_model : Mapped[str] = mapped_column(String(100), nullable=False)
+    doc_ids : Mapped[list[int]] = mapped_column(ARRAY(Integer), nullable=False)
+    attempts : Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    worker_id : Mapped[str | None] = mapped_column(String(100), nullable=True)
+    error : Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,server_default=func.now())
+    started_at : Mapped[datetime | None] = mapped_column(DateTime(timezone=True),nullable=True)
+    heartbeat_at : Mapped[datetime | None] = mapped_column(DateTime(timezone=True),nullable=True)
+    finished_at : Mapped[datetime | None] = mapped_column(DateTime(timezone=True),nullable=True)
+
+
+# per document checkpoint of a job, a restarted job only processes documents which are not done
+class IngestionJobDocument(Base):
+    __tablename__ = 'ingestion_job_document'
+
+    job_id : Mapped[int] = mapped_column(Integer, ForeignKey('ingestion_job.id', ondelete='CASCADE'), primary_key=True)
+    doc_id : Mapped[int] = mapped_column(Integer, primary_key=True)
+    status : Mapped[str] = mapped_column(String(20), nullable=False, default="pending")  # pending | running | done | failed
+    chunks : Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    parse_seconds : Mapped[float] = mapped_column(Float, nullable=False, default=0.0)
+    embed_seconds : Mapped[float] = mapped_column(Float, nullable=False, default=0.0)
+    error : Mapped[str | None] = mapped_column(Text, nullable=True)
+    updated_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,server_default=func.now(),onupdate=func.now())
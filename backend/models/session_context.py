@@ -0,0 +1,15 @@
+from sqlalchemy import Integer, String, DateTime, func
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import Mapped, mapped_column
+from datetime import datetime
+
+from models import Base
+
+
+class SessionContext(Base):
+    __tablename__ = 'session_context'
+
+    session_id : Mapped[str] = mapped_column(String(100), primary_key=True)
+    doc_ids : Mapped[list[int]] = mapped_column(ARRAY(Integer), nullable=False)
+    updated_at : Mapped[datetime] = mapped_column(DateTime(timezone=True),nullable=False,server_default=func.now(),onupdate=func.now())
+
@@ -14,6 +14,7 @@ class ModelName(str, Enum):
 
 class EmbeddingModelName(str, Enum):
     TXT_EMBDG_3_SMALL = "text-embedding-3-small"
+    TXT_EMBDG_3_LARGE = "text-embedding-3-large"
     
 class ModelPersona(str, Enum):
     DEF = "Default"
@@ -29,10 +30,59 @@ class QueryInput(PydanticBaseModel):
     session_id: str | None = None
     model: str | None = ModelName.GPT4_1_NANO
     persona: str | None = ModelPersona.DEF
+    doc_ids: list[int] | None = None
+    ef_search: int | None = Field(default=None, ge=1, le=1000)
+    probes: int | None = Field(default=None, ge=1)
+    hybrid: bool | None = None
+    embedding_model: EmbeddingModelName | None = None
+
+class PackedChunk(PydanticBaseModel):
+    doc_id: int | None = None
+    page: int | None = None
+    start_index: int | None = None
+    score: float | None = None
+    chunks: int = 1
+    lexical: bool = False
+    tokens: int
+
+class ContextPacking(PydanticBaseModel):
+    candidates: int = 0
+    below_score: int = 0
+    merged: int = 0
+    duplicates: int = 0
+    over_budget: int = 0
+    tokens: int = 0
+    budget: int = 0
+    chunks: list[PackedChunk] = []
+
+class RetrievalTrace(PydanticBaseModel):
+    rewrite_path: str | None = None
+    standalone_question: str | None = None
+    speculative: bool = False
+    speculation_hit: bool | None = None
+    similarity: float | None = None
+    answer_cache_hit: bool = False
+    answer_cache_similarity: float | None = None
+    rewrite_ms: float | None = None
+    retrieval_ms: float | None = None
+    context: ContextPacking | None = None
 
 class QueryResponse(PydanticBaseModel):
     answer: str
     session_id: str
+    trace: RetrievalTrace | None = None
+
+class ChainRegistryStats(PydanticBaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    hit_ratio: float
+
+class ContextualizerStats(PydanticBaseModel):
+    paths: dict[str, int]
+    llm_call_ratio: float
+    cache_size: int
 
 class ChatHistory(PydanticBaseModel):
     session_id: str | None = None
@@ -48,6 +98,8 @@ class DocRequest(CustomBaseModel):
     name: str
     is_active:bool
     uploaded_at: datetime
+    ingestion_state: str = "pending"
+    chunk_count: int = 0
 
 class DocResponse(DocRequest):
     pass
@@ -56,13 +108,53 @@ class DocResponse(DocRequest):
 
 
 # Document embedding Schema
+class DocTiming(PydanticBaseModel):
+    id: int
+    name: str
+    chunks: int = 0
+    parse_seconds: float = 0.0
+    embed_seconds: float = 0.0
+    success: bool
+
 class DocContextRequest(PydanticBaseModel):
     ids: list[int]
-    embedding_model: str | None = EmbeddingModelName.TXT_EMBDG_3_SMALL
+    embedding_model: EmbeddingModelName | None = EmbeddingModelName.TXT_EMBDG_3_SMALL
     
 class DocContextResponse(PydanticBaseModel):
     success: bool
     message: str
+    job_id: int | None = None
+
+
+# Ingestion job Schema
+class IngestionDocStatus(CustomBaseModel):
+    doc_id: int
+    status: str
+    chunks: int
+    parse_seconds: float
+    embed_seconds: float
+    error: str | None = None
+
+class IngestionJobStatus(PydanticBaseModel):
+    id: int
+    status: str
+    embedding_model: str
+    attempts: int
+    workers: int
+    error: str | None = None
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    total: int
+    pending: int
+    running: int
+    done: int
+    failed: int
+    chunks: int
+    elapsed_seconds: float
+    docs_per_second: float
+    chunks_per_second: float
+    documents: list[IngestionDocStatus] = []
 
 
 class DocActivateRequest(DocContextRequest):
@@ -87,6 +179,42 @@ class DocVectorResponse(DocContextResponse):
 
 
 
+# Embedding cache Schema
+class EmbeddingCacheStats(PydanticBaseModel):
+    model: str
+    rows: int
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+
+
+# Answer cache Schema
+class AnswerCacheStats(PydanticBaseModel):
+    rows: int
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+
+
+# Retrieval cache Schema
+class LRUCacheStats(PydanticBaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    hit_ratio: float
+
+class RetrievalCacheStats(PydanticBaseModel):
+    query_embeddings: LRUCacheStats
+    results: LRUCacheStats
+
+
+
+
 # Document Delete Schema
 class DocDeleteRequest(PydanticBaseModel):
     id: int
@@ -95,4 +223,28 @@ class DocDeleteResponse(PydanticBaseModel):
     success: bool
     filename: str
     message: str
+
+class DocUploadItem(PydanticBaseModel):
+    filename: str
+    success: bool
+    message: str
+    status_code: int = 200
+    id: int | None = None
+    duplicate: bool = False
+
+class DocBulkUploadResponse(PydanticBaseModel):
+    items: list[DocUploadItem]
+    job_id: int | None = None
+
+class DocBulkDeleteRequest(PydanticBaseModel):
+    ids: list[int]
+
+class DocBulkDeleteItem(PydanticBaseModel):
+    id: int
+    success: bool
+    filename: str | None = None
+    message: str
+
+class DocBulkDeleteResponse(PydanticBaseModel):
+    items: list[DocBulkDeleteItem]
     
\ No newline at end of file
@@ -0,0 +1,75 @@
+# Drops stored vectors whose dimension no longer matches EMBEDDING_DIMENSIONS, so the ANN index can be rebuilt.
+#
+#   cd backend && EMBEDDING_DIMENSIONS=768 python -m scripts.migrate_embedding_dimensions --yes --reingest
+#
+# Every collection shares the embedding column, all of them are emptied. Library rows go back to pending,
+# cached answers are invalidated and, with --reingest, every document is queued for the ingestion worker
+# (default embedding model, other models re-embed on their next context build).
+# Without --yes the script only reports what it would do.
+
+from sqlalchemy import text, select, update
+import argparse
+import asyncio
+
+from commons import AsyncSessionLocal
+from models import Document
+from utils import ingestion
+from utils.answer_cache import bump_context_version
+from utils.vector_index import EMBEDDING_DIMENSIONS, INDEX_NAME, vector_table_exists, stored_dimensions, ensure_vector_index
+
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Reset stored vectors to the configured embedding dimension")
+    parser.add_argument("--yes", action="store_true", help="drop the stored vectors, without it nothing is changed")
+    parser.add_argument("--reingest", action="store_true", help="queue every library document for ingestion afterwards")
+    return parser.parse_args()
+
+
+async def main():
+
+    args = parse_args()
+
+    async with AsyncSessionLocal() as db:
+
+        if not await vector_table_exists(db):
+            print("langchain_pg_embedding does not exist, nothing to migrate")
+            return
+
+        stored = await stored_dimensions(db)
+        if stored is None or stored == EMBEDDING_DIMENSIONS:
+            print(f"stored vectors already have {EMBEDDING_DIMENSIONS} dimensions, nothing to migrate")
+            return
+
+        result = await db.execute(text("SELECT count(*) FROM langchain_pg_embedding"))
+        rows = result.scalar()
+        print(f"{rows} stored vectors have {stored} dimensions, {EMBEDDING_DIMENSIONS} configured")
+
+        if not args.yes:
+            print("run again with --yes to drop them and reset the library ingestion state")
+            return
+
+        # vectors and ingestion state go together, the library never reports vectors which are gone
+        await db.execute(text(f"DROP INDEX IF EXISTS {INDEX_NAME}"))
+        await db.execute(text("TRUNCATE langchain_pg_embedding"))
+        await db.execute(update(Document).values(ingestion_state="pending", chunk_count=0))
+        await db.commit()
+
+        # answers cached against the dropped vectors
+        await bump_context_version(db)
+        await ensure_vector_index(db)
+        print(f"dropped {rows} vectors, embedding column is now vector({EMBEDDING_DIMENSIONS})")
+
+        if args.reingest:
+            result = await db.execute(select(Document.id).order_by(Document.id))
+            doc_ids = list(result.scalars().all())
+
+            if doc_ids:
+                job = await ingestion.enqueue(doc_ids, None, db)
+                print(f"ingestion job {job.id} queued for {len(doc_ids)} documents")
+        else:
+            print("documents are embedded again on their next context build")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,198 @@
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import select, update, delete, func
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass
+import hashlib
+import os
+
+from commons import db_dependency, AsyncSessionLocal, backend_log
+from models import AnswerCache, ContextVersion
+from schema import *
+
+
+
+# answers are reused above this cosine similarity of the standalone questions
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL_HOURS = int(os.getenv("ANSWER_CACHE_TTL_HOURS", 24))
+ANSWER_CACHE_MAX_ROWS = int(os.getenv("ANSWER_CACHE_MAX_ROWS", 50_000))
+
+# eviction runs once every this many stores
+EVICT_EVERY = 100
+
+
+
+# answers are scoped by document set and by the embedding model which retrieved their context
+def doc_set_hash(doc_ids: list[int], embedding_model: str | None = None) -> str:
+    scope = ",".join(map(str, sorted(set(doc_ids))))
+    if embedding_model:
+        scope = f"{getattr(embedding_model, 'value', embedding_model)}:{scope}"
+    return hashlib.sha256(scope.encode("utf-8")).hexdigest()
+
+
+
+#--------- Context version --------#
+
+# every answer is stamped with the context version, a bump makes all older answers unreachable
+async def get_context_version(db: db_dependency) -> int:
+    result = await db.execute(select(ContextVersion.version).where(ContextVersion.id == 1))
+    return result.scalar() or 0
+
+
+async def bump_context_version(db: db_dependency) -> int:
+
+    result = await db.execute(
+        insert(ContextVersion)
+        .values(id=1, version=1)
+        .on_conflict_do_update(index_elements=[ContextVersion.id], set_={"version": ContextVersion.version + 1, "updated_at": func.now()})
+        .returning(ContextVersion.version)
+    )
+    version = result.scalar()
+
+    # answers of older versions can never be hit again
+    await db.execute(delete(AnswerCache).where(AnswerCache.context_version < version))
+    await db.commit()
+
+    backend_log.info(f'Context version bumped to {version}, answer cache invalidated')
+    return version
+
+
+
+#--------- Semantic answer cache --------#
+@dataclass(frozen=True)
+class AnswerCacheKey:
+    model: str
+    persona: str
+    context_version: int
+    doc_set_hash: str
+
+
+class SemanticAnswerCache:
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, ttl_hours: int = ANSWER_CACHE_TTL_HOURS, max_rows: int = ANSWER_CACHE_MAX_ROWS):
+        self.threshold = threshold
+        self.ttl_hours = ttl_hours
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+
+    # the key is read once per request, an answer generated before a rebuild is stored under the old version
+    async def key(self, model: str, persona: str, doc_ids: list[int], embedding_model: str | None = None) -> AnswerCacheKey:
+
+        async with AsyncSessionLocal() as db:
+            version = await get_context_version(db)
+
+        return AnswerCacheKey(str(getattr(model, "value", model)), str(getattr(persona, "value", persona)), version, doc_set_hash(doc_ids, embedding_model))
+
+
+    async def lookup(self, embedding: list[float], key: AnswerCacheKey) -> tuple[str, float] | None:
+
+        try:
+            async with AsyncSessionLocal() as db:
+
+                distance = AnswerCache.embedding.cosine_distance(embedding)
+                cutoff = datetime.now(timezone.utc) - timedelta(hours=self.ttl_hours)
+
+                result = await db.execute(
+                    select(AnswerCache.id, AnswerCache.answer, distance.label("distance"))
+                    .where(
+                        AnswerCache.model == key.model,
+                        AnswerCache.persona == key.persona,
+                        AnswerCache.context_version == key.context_version,
+                        AnswerCache.doc_set_hash == key.doc_set_hash,
+                        AnswerCache.created_at > cutoff,
+                    )
+                    .order_by(distance)
+                    .limit(1)
+                )
+                row = result.first()
+
+                if row is None or 1 - row.distance < self.threshold:
+                    self.misses += 1
+                    return None
+
+                await db.execute(
+                    update(AnswerCache).where(AnswerCache.id == row.id).values(hits=AnswerCache.hits + 1, last_hit_at=func.now())
+                )
+                await db.commit()
+
+                self.hits += 1
+                return row.answer, 1 - row.distance
+
+        except SQLAlchemyError as e:
+            # cache is an optimization, a failing lookup just generates the answer
+            backend_log.info(f'Exception while looking up answer cache : {e}')
+            return None
+
+
+    async def store(self, embedding: list[float], question: str, answer: str, key: AnswerCacheKey):
+
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    insert(AnswerCache).values(
+                        model=key.model,
+                        persona=key.persona,
+                        context_version=key.context_version,
+                        doc_set_hash=key.doc_set_hash,
+                        question=question,
+                        embedding=embedding,
+                        answer=answer,
+                    )
+                )
+                await db.commit()
+
+            self.stores += 1
+            if self.stores % EVICT_EVERY == 0:
+                await self.evict()
+
+        except SQLAlchemyError as e:
+            backend_log.info(f'Exception while storing in answer cache : {e}')
+
+
+    async def evict(self) -> int:
+
+        evicted = 0
+
+        async with AsyncSessionLocal() as db:
+
+            # TTL : expired answers
+            cutoff = datetime.now(timezone.utc) - timedelta(hours=self.ttl_hours)
+            result = await db.execute(delete(AnswerCache).where(AnswerCache.created_at < cutoff))
+            evicted += result.rowcount
+
+            # LRU : keep only the max_rows most recently hit answers
+            keep = (
+                select(AnswerCache.last_hit_at)
+                .order_by(AnswerCache.last_hit_at.desc())
+                .offset(self.max_rows - 1)
+                .limit(1)
+                .scalar_subquery()
+            )
+            result = await db.execute(delete(AnswerCache).where(AnswerCache.last_hit_at < keep))
+            evicted += result.rowcount
+
+            await db.commit()
+
+        backend_log.info(f'Answer cache eviction removed {evicted} answers')
+        return evicted
+
+
+    async def stats(self) -> AnswerCacheStats:
+
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(func.count()).select_from(AnswerCache))
+            rows = result.scalar()
+
+        total = self.hits + self.misses
+        return AnswerCacheStats(
+            rows=rows,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / total if total else 0.0,
+        )
+
+
+answer_cache = SemanticAnswerCache()
@@ -0,0 +1,131 @@
+from langchain_postgres import PGVector
+from pgvector.psycopg import register_vector_async
+from psycopg.types.json import Jsonb
+from sqlalchemy.engine import make_url
+import asyncio
+import psycopg
+import uuid
+
+from commons import backend_log
+from utils.vector_index import INDEX_NAME, TEXT_SEARCH_COLUMN_SQL, TEXT_SEARCH_INDEX_SQL, TEXT_SEARCH_EXISTS_SQL
+
+
+
+#--------- Bulk vector loader --------#
+class VectorBulkLoader:
+
+    # streams vectors with binary COPY into an index free staging table. each document is published on its own,
+    # with an INSERT .. SELECT in a short transaction once all of its vectors are staged, so a failed document
+    # is discarded without ever being visible and finished documents don't wait for the rest of the job.
+    # aadd_embeddings mirrors the VectorStore method, the embedding pipeline can load through either.
+    def __init__(self, vector_store: PGVector, db_string: str):
+        self.vector_store = vector_store
+        self.conninfo = make_url(db_string).set(drivername="postgresql").render_as_string(hide_password=False)
+        self.conn: psycopg.AsyncConnection | None = None
+        self.collection_id = None
+        self.rows = 0
+
+        # COPY of the insert worker and publications share the connection, one operation at a time
+        self.lock = asyncio.Lock()
+
+
+    async def start(self):
+
+        # PGVector creates its tables and collection lazily, a fresh database has neither
+        await self.vector_store.acreate_vector_extension()
+        await self.vector_store.acreate_tables_if_not_exists()
+        await self.vector_store.acreate_collection()
+
+        self.conn = await psycopg.AsyncConnection.connect(self.conninfo)
+        await register_vector_async(self.conn)
+
+        async with self.conn.cursor() as cur:
+
+            # hybrid retrieval needs the full text column as soon as vectors are visible, it is created with the
+            # tables in its own short transaction, never left to index maintenance at the end of a build
+            await cur.execute(f"SELECT {TEXT_SEARCH_EXISTS_SQL}")
+            if not (await cur.fetchone())[0]:
+                await cur.execute(TEXT_SEARCH_COLUMN_SQL)
+                await cur.execute(TEXT_SEARCH_INDEX_SQL)
+            await self.conn.commit()
+
+            await cur.execute("SELECT uuid FROM langchain_pg_collection WHERE name = %s", (self.vector_store.collection_name,))
+            self.collection_id = (await cur.fetchone())[0]
+
+            # lives as long as the connection, publications commit without dropping it
+            await cur.execute("""
+                CREATE TEMP TABLE embedding_staging (
+                    id varchar, collection_id uuid, embedding vector, document varchar, cmetadata jsonb
+                )
+            """)
+            await self.conn.commit()
+
+
+    async def aadd_embeddings(self, texts: list[str], embeddings: list[list[float]], metadatas: list[dict], **kwargs) -> list[str]:
+
+        ids = [str(uuid.uuid4()) for _ in texts]
+
+        async with self.lock, self.conn.cursor() as cur:
+            async with cur.copy("COPY embedding_staging (id, collection_id, embedding, document, cmetadata) FROM STDIN (FORMAT BINARY)") as copy:
+                copy.set_types(["varchar", "uuid", "vector", "varchar", "jsonb"])
+
+                for row_id, content, embedding, metadata in zip(ids, texts, embeddings, metadatas):
+                    await copy.write_row((row_id, self.collection_id, embedding, content, Jsonb(metadata)))
+
+        self.rows += len(ids)
+        return ids
+
+
+    # publishes the staged vectors of one document, returns the number of rows published
+    async def publish(self, doc_id: int) -> int:
+
+        async with self.lock, self.conn.cursor() as cur:
+
+            # concurrent jobs may embed the same document (upload and build context), publications of a document
+            # in a collection are serialized and only the first one is kept
+            await cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s), %s)", (self.vector_store.collection_name, doc_id))
+            await cur.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM langchain_pg_embedding
+                    WHERE collection_id = %s AND (cmetadata->>'doc_id')::int = %s
+                )
+            """, (self.collection_id, doc_id))
+            published = 0
+
+            if (await cur.fetchone())[0]:
+                backend_log.info(f'Document {doc_id} already embedded in {self.vector_store.collection_name}, staged vectors discarded')
+
+            else:
+                # a genuinely empty table serves nothing, it is loaded without the ANN index which ensure_vector_index
+                # builds once afterwards. a live index is never dropped, its lock would block retrieval for the whole load
+                await cur.execute("SELECT NOT EXISTS (SELECT 1 FROM langchain_pg_embedding)")
+                if (await cur.fetchone())[0]:
+                    backend_log.info(f'Loading document {doc_id} into an empty table, without ANN index')
+                    await cur.execute(f"DROP INDEX IF EXISTS {INDEX_NAME}")
+
+                await cur.execute("""
+                    INSERT INTO langchain_pg_embedding (id, collection_id, embedding, document, cmetadata)
+                    SELECT id, collection_id, embedding, document, cmetadata FROM embedding_staging
+                    WHERE (cmetadata->>'doc_id')::int = %s
+                """, (doc_id,))
+                published = cur.rowcount
+
+            await cur.execute("DELETE FROM embedding_staging WHERE (cmetadata->>'doc_id')::int = %s", (doc_id,))
+            await self.conn.commit()
+
+        backend_log.info(f'Bulk loaded {published} vectors of document {doc_id}')
+        return published
+
+
+    # drops the staged vectors of a failed document
+    async def discard(self, doc_id: int):
+
+        async with self.lock, self.conn.cursor() as cur:
+            await cur.execute("DELETE FROM embedding_staging WHERE (cmetadata->>'doc_id')::int = %s", (doc_id,))
+            await self.conn.commit()
+
+
+    # vectors staged but never published disappear with the connection
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
@@ -1,54 +1,70 @@
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains.history_aware_retriever import create_history_aware_retriever
-from langchain.chains.retrieval import create_retrieval_chain
 
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
 
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert
 from langchain_openai import ChatOpenAI
-
-from commons import db_dependency, backend_log
-from models import Chat
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+import threading
+import time
+import asyncio
+import httpx
+import math
+
+from commons import db_dependency, AsyncSessionLocal, backend_log
+from models import Chat, ChatSummary, SessionContext, Document
 from schema import *
 import uuid
+import os
 
 
 
-from utils.document import vector_store
+from utils.document import get_embedder, collection_name, embedding_model_name
+from utils.retriever import PGVectorRetriever
+from utils.contextualize import contextualizer, is_follow_up, REWRITE_MODEL
+from utils.answer_cache import answer_cache
+from utils.tokens import count_tokens
+from utils.context_packer import context_packer, CONTEXT_CANDIDATES
 
-retriever = vector_store.as_retriever(search_kwargs={"k": 2})
+# speculative results on the raw question are reused when the rewrite is this similar (cosine)
+SPECULATION_THRESHOLD = float(os.getenv("SPECULATION_THRESHOLD", 0.9))
 
-# initiate an output parser
-output_parser = StrOutputParser()
 
+# retriever restricted to the session documents, with the request's ANN search params
+def get_retriever(request: QueryInput, doc_ids: list[int], context_version: int | None = None) -> PGVectorRetriever:
 
+    settings = {}
+    if request.ef_search:
+        settings["ef_search"] = request.ef_search
+    if request.probes:
+        settings["probes"] = request.probes
+    if request.hybrid is not None:
+        settings["hybrid"] = request.hybrid
 
+    return PGVectorRetriever(
+        embedder=get_embedder(request.embedding_model),
+        collection_name=collection_name(request.embedding_model),
+        k=CONTEXT_CANDIDATES,
+        doc_ids=doc_ids,
+        context_version=context_version,
+        **settings,
+    )
 
 
-# This prompt is used to modify the question by adding context to an uncontextualized_question
 
-prompt_to_contextualize_question = (
-    "Given a chat history and the latest user question "
-    "which might reference context in the chat history, "
-    "formulate a standalone question which can be understood "
-    "without the chat history. Do NOT answer the question, "
-    "just reformulate it if needed and otherwise return it as is."
-)
+# initiate an output parser
+output_parser = StrOutputParser()
 
-contextualize_question_template = ChatPromptTemplate.from_messages(
-        [
-            ("system", prompt_to_contextualize_question),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ]
-    )
 
 
 
-def get_conversation_prompt_template(persona: str = 'default') -> ChatPromptTemplate:
+def get_conversation_prompt_template(persona: str = ModelPersona.DEF) -> ChatPromptTemplate:
 
-    if persona == 'default':
+    if not persona or persona == ModelPersona.DEF:
         base_prompt = "You are a helpful AI assistant.Use the following context to answer the user's question."
 
     else:
@@ -67,52 +83,396 @@ def get_conversation_prompt_template(persona: str = 'default') -> ChatPromptTemp
     return conversation_prompt_template
 
 
-def get_rag_chain(model: str = "gpt-4o-mini"):
+#--------- Shared LLM clients --------#
 
-    # Use Specific model for this conversation
-    LLM = ChatOpenAI(model=model)
+# one keep-alive connection pool shared by every LLM client, no TLS handshake per request
+http_limits = httpx.Limits(
+    max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", 100)),
+    max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", 20)),
+    keepalive_expiry=60,
+)
+http_client = httpx.Client(limits=http_limits, timeout=60)
+http_async_client = httpx.AsyncClient(limits=http_limits, timeout=60)
 
-    conversation_prompt_template = get_conversation_prompt_template()
+llm_clients: dict[str, ChatOpenAI] = {}
 
-    # fetches document from retriver based on user input and also use chat history to contextualize 
-    history_aware_retriever = create_history_aware_retriever(LLM, retriever, contextualize_question_template)
 
-    # using the conversation prompt template 
-    question_answer_chain = create_stuff_documents_chain(LLM, conversation_prompt_template)
+def get_llm(model: str) -> ChatOpenAI:
 
-    # Chain, chat history, context and current question
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)    
-    
+    model = str(getattr(model, "value", model))
+
+    if model not in llm_clients:
+        llm_clients[model] = ChatOpenAI(model=model, http_client=http_client, http_async_client=http_async_client)
+
+    return llm_clients[model]
+
+
+
+#--------- Answer chain --------#
+def build_answer_chain(model: str = ModelName.GPT4_O_MINI, persona: str = ModelPersona.DEF):
+
+    # Use Specific model for this conversation
+    LLM = get_llm(model)
+
+    conversation_prompt_template = get_conversation_prompt_template(persona)
+
+    # using the conversation prompt template, answers from chat history, context and current question
+    question_answer_chain = create_stuff_documents_chain(LLM, conversation_prompt_template)
     
-    return rag_chain
+    return question_answer_chain
+
+
+
+#--------- Speculative retrieval --------#
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+# returns the standalone question, its embedding and (when speculation hit) its documents
+async def contextualize_with_speculation(question: str, chat_history: list, rewrite_llm: ChatOpenAI, retriever: PGVectorRetriever, trace: RetrievalTrace):
 
+    started = time.perf_counter()
 
+    # a rewrite LLM call is coming, search with the raw question meanwhile
+    speculation = None
+    if chat_history and is_follow_up(question) and not contextualizer.is_cached(question, chat_history):
 
+        async def speculate():
+            embedding = await retriever.embedder.aembed_query(question)
+            return embedding, await retriever.asearch(embedding, question)
 
-def fetch_history(session_id : uuid.UUID, db: db_dependency):
+        speculation = asyncio.create_task(speculate())
 
     try:
-        chat_history = db.query(Chat).filter(Chat.session_id == session_id).order_by(Chat.created_at).all()
+        standalone_question, trace.rewrite_path = await contextualizer.contextualize(question, chat_history, rewrite_llm)
+    except Exception:
+        if speculation:
+            speculation.cancel()
+        raise
+
+    trace.standalone_question = standalone_question
+    trace.rewrite_ms = (time.perf_counter() - started) * 1000
+
+    if speculation is None:
+        return standalone_question, await retriever.embedder.aembed_query(standalone_question), None
+
+    trace.speculative = True
+    try:
+        if standalone_question == question:
+            # rewrite kept the question as is, speculative results are exact
+            standalone_embedding, docs = await speculation
+            trace.similarity = 1.0
+
+        else:
+            (question_embedding, docs), standalone_embedding = await asyncio.gather(
+                speculation, retriever.embedder.aembed_query(standalone_question)
+            )
+            trace.similarity = cosine_similarity(question_embedding, standalone_embedding)
+
+        trace.speculation_hit = trace.similarity >= SPECULATION_THRESHOLD
+
+    except Exception as e:
+        backend_log.info(f'Speculative retrieval failed : {e}')
+        trace.speculation_hit = False
+        return standalone_question, await retriever.embedder.aembed_query(standalone_question), None
+
+    return standalone_question, standalone_embedding, docs if trace.speculation_hit else None
+
+
+
+#--------- RAG pipeline --------#
+async def astream_answer(request: QueryInput, chat_history: list, doc_ids: list[int], trace: RetrievalTrace) -> AsyncIterator[str]:
+
+    started = time.perf_counter()
+
+    model, persona = ChainRegistry.key(request.model or ModelName.GPT4_1_NANO, request.persona)
+    answer_chain = chain_registry.get(model, persona)
+
+    # context version keys both the answer cache and the retrieval result cache
+    cache_key = await answer_cache.key(model, persona, doc_ids, embedding_model_name(request.embedding_model))
+    retriever = get_retriever(request, doc_ids, cache_key.context_version)
+
+    # follow up questions are rewritten by the (cheap) rewrite model, unless the fast path can skip it
+    rewrite_llm = get_llm(REWRITE_MODEL or model)
+
+    standalone_question, embedding, docs = await contextualize_with_speculation(request.question, chat_history, rewrite_llm, retriever, trace)
+
+    # near identical standalone question over the same documents was answered already
+    cached = await answer_cache.lookup(embedding, cache_key)
+
+    if cached:
+        trace.answer_cache_hit = True
+        trace.answer_cache_similarity = cached[1]
+        trace.retrieval_ms = (time.perf_counter() - started) * 1000
+        backend_log.info(f'Retrieval trace : {trace.model_dump()}')
+
+        yield cached[0]
+        return
+
+    if docs is None:
+        docs = await retriever.asearch(embedding, standalone_question)
+
+    # over-fetched candidates are merged, deduplicated and cut to the model's context budget
+    docs, trace.context = context_packer.pack(docs, model)
+
+    trace.retrieval_ms = (time.perf_counter() - started) * 1000
+    backend_log.info(f'Retrieval trace : {trace.model_dump()}')
+
+    tokens = []
+    async for token in answer_chain.astream({"input": request.question, "chat_history": chat_history, "context": docs}):
+        tokens.append(token)
+        yield token
+
+    answer = "".join(tokens)
+    if answer:
+        await answer_cache.store(embedding, standalone_question, answer, cache_key)
+
+
+
+#--------- Chain registry --------#
+class ChainRegistry:
+
+    # bounded LRU of compiled answer chains keyed by (model, persona)
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._chains: OrderedDict[tuple[str, str], object] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, persona: str) -> tuple[str, str]:
+        persona = persona or ModelPersona.DEF
+        return (str(getattr(model, "value", model)), str(getattr(persona, "value", persona)))
+
+    def get(self, model: str, persona: str):
+
+        key = self.key(model, persona)
+
+        with self._lock:
+            if key in self._chains:
+                self.hits += 1
+                self._chains.move_to_end(key)
+                return self._chains[key]
+
+            self.misses += 1
+
+        chain = build_answer_chain(*key)
+        self._put(key, chain)
+
+        return chain
+
+    def _put(self, key: tuple[str, str], chain):
+
+        with self._lock:
+            self._chains[key] = chain
+            self._chains.move_to_end(key)
+
+            # evict least recently used chains
+            while len(self._chains) > self.max_size:
+                self._chains.popitem(last=False)
+
+    def warm(self):
+
+        # build every (model, persona) combination ahead of traffic, does not count as misses
+        for model in ModelName:
+            for persona in ModelPersona:
+                key = self.key(model, persona)
+                if key not in self._chains:
+                    self._put(key, build_answer_chain(*key))
+
+        backend_log.info(f'Chain registry warmed with {len(self._chains)} chains')
+
+    def stats(self) -> ChainRegistryStats:
+        total = self.hits + self.misses
+        return ChainRegistryStats(
+            size=len(self._chains),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / total if total else 0.0,
+        )
+
+
+chain_registry = ChainRegistry(max_size=int(os.getenv("CHAIN_REGISTRY_SIZE", 32)))
+
+
+
+#--------- Session context --------#
+
+# documents a session retrieves from : request ids (remembered for the session) > session ids > globally active docs
+async def resolve_context(session_id: str, doc_ids: list[int] | None, db: db_dependency) -> list[int]:
+
+    try:
+        if doc_ids is not None:
+            await db.execute(
+                insert(SessionContext)
+                .values(session_id=session_id, doc_ids=doc_ids)
+                .on_conflict_do_update(index_elements=[SessionContext.session_id], set_={"doc_ids": doc_ids, "updated_at": func.now()})
+            )
+            await db.commit()
+            return doc_ids
+
+        result = await db.execute(select(SessionContext.doc_ids).where(SessionContext.session_id == session_id))
+        session_doc_ids = result.scalar()
+        if session_doc_ids is not None:
+            return session_doc_ids
+
+        result = await db.execute(select(Document.id).where(Document.is_active == True))
+        return list(result.scalars().all())
+
+    except SQLAlchemyError as e:
+        backend_log.info(f' Exception while resolving session context : {e}')
+
+        await db.rollback()  # Rollback in case of error
+        raise Exception(f"Error while resolving session context: {e}")
+
+
+
+#--------- Rolling chat history --------#
+
+# prompt token budget for chat history (summary + verbatim turns) per answer model
+HISTORY_TOKEN_BUDGET = {
+    ModelName.GPT4_1_NANO.value: 8000,
+    ModelName.GPT4_O_MINI.value: 6000,
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 4000
+
+# most recent turns kept out of the session summary. turns are folded in blocks : once more than HISTORY_FOLD_TURNS
+# are unsummarized, all but the HISTORY_KEEP_TURNS most recent go into the summary with a single call
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", 4))
+HISTORY_FOLD_TURNS = int(os.getenv("HISTORY_FOLD_TURNS", 2 * HISTORY_KEEP_TURNS))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 400))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", ModelName.GPT4_1_NANO.value)
+
+summary_prompt_template = ChatPromptTemplate.from_messages(
+    [
+        ("system", "You maintain a running summary of a conversation between a user and an AI assistant. "
+                   "Extend the current summary with the new turns. Keep facts, names, numbers and open questions "
+                   "the user may refer back to, drop pleasantries. Reply with the updated summary only, "
+                   "in at most {max_words} words."),
+        ("human", "Current summary:\n{summary}\n\nNew turns:\n{turns}"),
+    ]
+)
+
+
+async def fetch_history(session_id : uuid.UUID, db: db_dependency, model: str = ModelName.GPT4_1_NANO):
+
+    model = str(getattr(model, "value", model))
+    budget = HISTORY_TOKEN_BUDGET.get(model, DEFAULT_HISTORY_TOKEN_BUDGET)
+
+    try:
+        result = await db.execute(select(ChatSummary).where(ChatSummary.session_id == session_id))
+        summary = result.scalars().first()
+
+        # only not yet summarized turns are loaded
+        query = select(Chat).where(Chat.session_id == session_id)
+        if summary:
+            query = query.where(Chat.id > summary.summarized_upto)
 
         messages = []
 
-        for chat in chat_history:
-            messages.extend([
-                {"role": "human", "content": chat.user_query},
-                {"role": "ai", "content": chat.gpt_response}
-            ])
+        if summary:
+            summary_content = f"Summary of the earlier conversation: {summary.summary}"
+            budget -= count_tokens(summary_content, model)
+            messages.append({"role": "system", "content": summary_content})
+
+        # newest turns first until the budget is spent, then restore chronological order.
+        # turns are read page by page, sessions whose folds failed can have many unsummarized turns
+        page_size = max(HISTORY_FOLD_TURNS, HISTORY_KEEP_TURNS, 1)
+        turns = []
+        full = False
+        page_query = query
+
+        while not full:
+            result = await db.execute(page_query.order_by(Chat.id.desc()).limit(page_size))
+            page = result.scalars().all()
+
+            for chat in page:
+                turn_tokens = count_tokens(chat.user_query, model) + count_tokens(chat.gpt_response, model)
+                if turns and turn_tokens > budget:
+                    full = True
+                    break
+
+                budget -= turn_tokens
+                turns.append([
+                    {"role": "human", "content": chat.user_query},
+                    {"role": "ai", "content": chat.gpt_response}
+                ])
+
+            if len(page) < page_size:
+                break
+
+            page_query = query.where(Chat.id < page[-1].id)
+
+        for turn in reversed(turns):
+            messages.extend(turn)
 
         return messages
 
     except SQLAlchemyError as e:
         backend_log.info(f' Exception while pulling chat history from DB : {e}')
         
-        db.rollback()  # Rollback in case of error
+        await db.rollback()  # Rollback in case of error
         raise Exception(f"Error while Fetching Chat history from DB: {e}")
 
 
+
+# fold turns older than the verbatim window into the stored summary, runs after the response is sent
+async def fold_history(session_id: str):
+
+    try:
+        async with AsyncSessionLocal() as db:
+
+            result = await db.execute(select(ChatSummary).where(ChatSummary.session_id == session_id))
+            summary = result.scalars().first()
+
+            query = select(Chat).where(Chat.session_id == session_id)
+            if summary:
+                query = query.where(Chat.id > summary.summarized_upto)
+
+            result = await db.execute(query.order_by(Chat.id))
+            unsummarized = result.scalars().all()
+
+            # nothing to do until a whole block of turns is waiting
+            if len(unsummarized) <= HISTORY_FOLD_TURNS:
+                return
+
+            to_fold = unsummarized[:-HISTORY_KEEP_TURNS] if HISTORY_KEEP_TURNS else unsummarized
+
+            turns = "\n".join(f"User: {chat.user_query}\nAssistant: {chat.gpt_response}" for chat in to_fold)
+
+            summarizer = summary_prompt_template | get_llm(SUMMARY_MODEL).bind(max_tokens=SUMMARY_MAX_TOKENS) | output_parser
+            new_summary = await summarizer.ainvoke({
+                "summary": summary.summary if summary else "(empty)",
+                "turns": turns,
+                "max_words": int(SUMMARY_MAX_TOKENS * 0.75),
+            })
+
+            # a concurrent fold may already have moved further, never move the summary backwards
+            await db.execute(
+                insert(ChatSummary)
+                .values(session_id=session_id, summary=new_summary, summarized_upto=to_fold[-1].id)
+                .on_conflict_do_update(
+                    index_elements=[ChatSummary.session_id],
+                    set_={"summary": new_summary, "summarized_upto": to_fold[-1].id, "updated_at": func.now()},
+                    where=ChatSummary.summarized_upto < to_fold[-1].id,
+                )
+            )
+            await db.commit()
+
+            backend_log.info(f'Session: {session_id} | {len(to_fold)} turns folded into history summary')
+
+    except Exception as e:
+        # summary is best effort, the turns stay in history and are folded on the next turn
+        backend_log.info(f'Session: {session_id} | Exception while folding chat history : {e}')
+
+
  
-def update_history(chat: ChatHistory, db: db_dependency):
+async def update_history(chat: ChatHistory, db: db_dependency):
 
     try:
 
@@ -128,10 +488,10 @@ def update_history(chat: ChatHistory, db: db_dependency):
 
         # Add and commit to the database
         db.add(chat_record)
-        db.commit()
+        await db.commit()
         
         # Refresh the db_doc object with the new data 
-        db.refresh(chat_record)
+        await db.refresh(chat_record)
         
         return chat_record
     
@@ -139,5 +499,5 @@ def update_history(chat: ChatHistory, db: db_dependency):
 
         backend_log.info(f' Exception while updating chat history : {e}')
 
-        db.rollback()  # Rollback in case of error
+        await db.rollback()  # Rollback in case of error
         raise Exception(f"Error while updating chat history: {e}")
@@ -0,0 +1,151 @@
+from langchain_core.documents import Document as LangChainDocument
+from collections import defaultdict
+import re
+import os
+
+from utils.tokens import count_tokens
+from schema import *
+
+
+
+# candidates fetched per query, the packer decides how many of them reach the prompt
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 12))
+
+# chunks below this cosine similarity are never packed
+CONTEXT_MIN_SCORE = float(os.getenv("CONTEXT_MIN_SCORE", 0.2))
+
+# share of a chunk's word shingles already present in a packed chunk which makes it a duplicate
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", 0.8))
+
+# prompt token budget for retrieved context per answer model
+CONTEXT_TOKEN_BUDGET = {
+    ModelName.GPT4_1_NANO.value: 6000,
+    ModelName.GPT4_O_MINI.value: 4000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000
+
+SHINGLE_SIZE = 3
+
+word_pattern = re.compile(r"\w+")
+
+
+
+# hybrid results are ranked by their fused rank, pure vector results by similarity
+def relevance(doc: LangChainDocument) -> float:
+    return doc.metadata.get("rrf", doc.metadata.get("score", 0))
+
+
+def shingles(content: str) -> set[tuple[str, ...]]:
+    words = word_pattern.findall(content.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+
+#--------- Context packer --------#
+class ContextPacker:
+
+    # turns over-fetched search results into the most relevant, non overlapping context that fits the model budget
+    def __init__(self, min_score: float = CONTEXT_MIN_SCORE, dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD):
+        self.min_score = min_score
+        self.dedup_threshold = dedup_threshold
+
+
+    @staticmethod
+    def merge_adjacent(docs: list[LangChainDocument]) -> list[LangChainDocument]:
+
+        # splits overlap by chunk_overlap characters, neighbours of the same page are stitched back together
+        groups = defaultdict(list)
+        merged = []
+
+        for doc in docs:
+            if "start_index" in doc.metadata:
+                groups[(doc.metadata.get("doc_id"), doc.metadata.get("page"))].append(doc)
+            else:
+                # chunks embedded before start offsets were recorded
+                merged.append(doc)
+
+        for group in groups.values():
+            group.sort(key=lambda doc: doc.metadata["start_index"])
+
+            current = group[0]
+            for doc in group[1:]:
+                current_end = current.metadata["start_index"] + len(current.page_content)
+                offset = current_end - doc.metadata["start_index"]
+
+                if offset < 0:
+                    merged.append(current)
+                    current = doc
+                    continue
+
+                current = LangChainDocument(
+                    page_content=current.page_content + doc.page_content[offset:],
+                    metadata={
+                        **current.metadata,
+                        "score": max(current.metadata.get("score", 0), doc.metadata.get("score", 0)),
+                        **({
+                            "rrf": max(relevance(current), relevance(doc)),
+                            "lexical_rank": current.metadata.get("lexical_rank") or doc.metadata.get("lexical_rank"),
+                        } if "rrf" in doc.metadata else {}),
+                        "chunks": current.metadata.get("chunks", 1) + 1,
+                    },
+                )
+
+            merged.append(current)
+
+        return merged
+
+
+    def pack(self, docs: list[LangChainDocument], model: str) -> tuple[list[LangChainDocument], ContextPacking]:
+
+        model = str(getattr(model, "value", model))
+        budget = CONTEXT_TOKEN_BUDGET.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+        packing = ContextPacking(candidates=len(docs), budget=budget)
+
+        # exact term matches are kept even when their embedding is far from the question
+        relevant = [
+            doc for doc in docs
+            if doc.metadata.get("score", 1.0) >= self.min_score or doc.metadata.get("lexical_rank") is not None
+        ]
+        packing.below_score = len(docs) - len(relevant)
+
+        candidates = self.merge_adjacent(relevant)
+        packing.merged = len(relevant) - len(candidates)
+
+        # most relevant first, both for the budget and for the order in the prompt
+        candidates.sort(key=relevance, reverse=True)
+
+        packed = []
+        packed_shingles = []
+
+        for doc in candidates:
+            doc_shingles = shingles(doc.page_content)
+
+            if any(len(doc_shingles & seen) >= self.dedup_threshold * len(doc_shingles) for seen in packed_shingles):
+                packing.duplicates += 1
+                continue
+
+            tokens = count_tokens(doc.page_content, model)
+            if packing.tokens + tokens > budget:
+                packing.over_budget += 1
+                continue
+
+            packing.tokens += tokens
+            packed.append(doc)
+            packed_shingles.append(doc_shingles)
+
+            packing.chunks.append(PackedChunk(
+                doc_id=doc.metadata.get("doc_id"),
+                page=doc.metadata.get("page"),
+                start_index=doc.metadata.get("start_index"),
+                score=doc.metadata.get("score"),
+                chunks=doc.metadata.get("chunks", 1),
+                lexical=doc.metadata.get("lexical_rank") is not None,
+                tokens=tokens,
+            ))
+
+        return packed, packing
+
+
+context_packer = ContextPacker()
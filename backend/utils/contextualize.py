@@ -0,0 +1,132 @@
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.language_models import BaseChatModel
+from collections import OrderedDict, Counter
+import hashlib
+import re
+import os
+
+from commons import backend_log
+from schema import *
+
+
+
+# This prompt is used to modify the question by adding context to an uncontextualized_question
+
+prompt_to_contextualize_question = (
+    "Given a chat history and the latest user question "
+    "which might reference context in the chat history, "
+    "formulate a standalone question which can be understood "
+    "without the chat history. Do NOT answer the question, "
+    "just reformulate it if needed and otherwise return it as is."
+)
+
+contextualize_question_template = ChatPromptTemplate.from_messages(
+        [
+            ("system", prompt_to_contextualize_question),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+        ]
+    )
+
+
+# rewrites go to the cheapest model regardless of the answer model, empty uses the answer model
+REWRITE_MODEL = os.getenv("REWRITE_MODEL", ModelName.GPT4_1_NANO.value)
+REWRITE_CACHE_SIZE = int(os.getenv("REWRITE_CACHE_SIZE", 10_000))
+
+
+
+#--------- Follow up detection --------#
+
+# words which refer back to earlier turns
+referring_pattern = re.compile(
+    r"\b("
+    r"it|its|itself|they|them|their|theirs|this|that|these|those|he|him|his|she|her|hers|ones"
+    r"|above|previous|previously|earlier|former|latter|same|aforementioned|mentioned"
+    r"|instead|further|elaborate|again"
+    r")\b",
+    re.IGNORECASE,
+)
+
+# openers which continue the previous turn
+continuation_pattern = re.compile(r"^\s*(and|but|so|also|then|what about|how about|why|more|else)\b", re.IGNORECASE)
+
+# questions this short are almost always follow ups ("the second one?", "any example?")
+SHORT_QUESTION_WORDS = 4
+
+
+def is_follow_up(question: str) -> bool:
+    return (
+        len(question.split()) <= SHORT_QUESTION_WORDS
+        or bool(continuation_pattern.search(question))
+        or bool(referring_pattern.search(question))
+    )
+
+
+
+#--------- Question contextualizer --------#
+class QuestionContextualizer:
+
+    # turns a follow up question into a standalone one, skipping the LLM call whenever it can
+    def __init__(self, cache_size: int = REWRITE_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.paths = Counter()
+        self._cache: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._output_parser = StrOutputParser()
+
+
+    @staticmethod
+    def cache_key(question: str, chat_history: list) -> tuple[str, str]:
+
+        # a rewrite only depends on the question and the turn it refers to
+        last_turn = "\n".join(message["content"] for message in chat_history[-2:])
+        return hashlib.sha256(last_turn.encode("utf-8")).hexdigest(), " ".join(question.lower().split())
+
+
+    def is_cached(self, question: str, chat_history: list) -> bool:
+        return self.cache_key(question, chat_history) in self._cache
+
+
+    async def contextualize(self, question: str, chat_history: list, llm: BaseChatModel) -> tuple[str, str]:
+
+        if not chat_history:
+            path = "no_history"
+            standalone = question
+
+        elif not is_follow_up(question):
+            path = "skipped"
+            standalone = question
+
+        else:
+            key = self.cache_key(question, chat_history)
+
+            if key in self._cache:
+                path = "cached"
+                self._cache.move_to_end(key)
+                standalone = self._cache[key]
+
+            else:
+                path = "rewritten"
+                chain = contextualize_question_template | llm | self._output_parser
+                standalone = await chain.ainvoke({"input": question, "chat_history": chat_history})
+
+                self._cache[key] = standalone
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        self.paths[path] += 1
+        backend_log.info(f'Question contextualization path : {path} | standalone question : {standalone}')
+
+        return standalone, path
+
+
+    def stats(self) -> ContextualizerStats:
+        total = sum(self.paths.values())
+        return ContextualizerStats(
+            paths=dict(self.paths),
+            llm_call_ratio=self.paths["rewritten"] / total if total else 0.0,
+            cache_size=len(self._cache),
+        )
+
+
+contextualizer = QuestionContextualizer()
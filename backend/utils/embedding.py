@@ -0,0 +1,433 @@
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document as LangChainDocument
+from langchain_core.vectorstores import VectorStore
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import select, update, delete, func
+from datetime import datetime, timedelta, timezone
+from openai import RateLimitError, APIConnectionError, InternalServerError
+from dataclasses import dataclass
+import tiktoken
+import hashlib
+import asyncio
+import random
+import time
+import os
+
+from commons import AsyncSessionLocal, LRUCache, backend_log
+from models import EmbeddingCache
+from schema import *
+
+
+
+# embedding pipeline settings
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 256))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", 50_000))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", 4))
+EMBED_RPM = int(os.getenv("EMBED_RPM", 3_000))
+EMBED_TPM = int(os.getenv("EMBED_TPM", 1_000_000))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", 6))
+
+# provider errors worth retrying : 429s, connection errors and timeouts, 5xx
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# in-process LRU of query embeddings, saves the provider round trip for repeated questions
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 10_000))
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def count_tokens(text: str) -> int:
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+
+#--------- Provider rate limiting --------#
+class TokenBucket:
+
+    # refills continuously at capacity per minute, acquire waits until enough budget is available
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: int = 1):
+
+        # a single request larger than the bucket can only wait for a full bucket
+        amount = min(amount, self.capacity)
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+
+                await asyncio.sleep((amount - self.available) / self.rate)
+
+
+class RateLimitedEmbeddings(Embeddings):
+
+    # keeps provider calls inside RPM / TPM budgets and retries transient errors with jittered exponential backoff,
+    # the provider client itself is built without retries so they are all paced here
+    def __init__(self, embedder: Embeddings, rpm: int = EMBED_RPM, tpm: int = EMBED_TPM, max_retries: int = EMBED_MAX_RETRIES):
+        self.embedder = embedder
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+
+
+    async def call(self, request, tokens: int):
+
+        for attempt in range(self.max_retries + 1):
+
+            await self.requests.acquire()
+            await self.tokens.acquire(tokens)
+
+            try:
+                return await request()
+
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+
+                delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+                backend_log.info(f'Embedding provider error ({type(e).__name__}), retry {attempt + 1} in {delay:.1f}s : {e}')
+                await asyncio.sleep(delay)
+
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        tokens = sum(count_tokens(text) for text in texts)
+        return await self.call(lambda: self.embedder.aembed_documents(texts), tokens)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return asyncio.run(self.aembed_documents(texts))
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.call(lambda: self.embedder.aembed_query(text), count_tokens(text))
+
+    def embed_query(self, text: str) -> list[float]:
+        return asyncio.run(self.aembed_query(text))
+
+
+
+#--------- Content hash embedding cache --------#
+class CachedEmbeddings(Embeddings):
+
+    # wraps a provider embedder, chunk vectors are looked up by (model, sha256) before calling the provider
+    def __init__(self, embedder: Embeddings, model: str):
+        self.embedder = embedder
+        self.model = str(getattr(model, "value", model))
+        self.hits = 0
+        self.misses = 0
+        self.query_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+
+        hashes = [content_hash(text) for text in texts]
+        vectors = await self.lookup(set(hashes))
+
+        # identical chunks inside the same batch are embedded only once
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in vectors:
+                missing.setdefault(text_hash, text)
+
+        self.hits += len(texts) - sum(1 for text_hash in hashes if text_hash in missing)
+        self.misses += len(missing)
+
+        if missing:
+            new_vectors = await self.embedder.aembed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), new_vectors))
+            await self.store(fresh)
+            vectors.update(fresh)
+
+        backend_log.info(f'Embedding cache : {len(texts) - len(missing)} hits, {len(missing)} misses for {len(texts)} chunks')
+
+        return [vectors[text_hash] for text_hash in hashes]
+
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return asyncio.run(self.aembed_documents(texts))
+
+
+    # queries are not chunks, they are cached in process only, keyed by (model, normalized text),
+    # the provider always embeds the query as typed
+    def query_key(self, text: str) -> tuple[str, str]:
+        return self.model, " ".join(text.split()).casefold()
+
+    async def aembed_query(self, text: str) -> list[float]:
+
+        key = self.query_key(text)
+        embedding = self.query_cache.get(key)
+
+        if embedding is None:
+            embedding = await self.embedder.aembed_query(text)
+            self.query_cache.put(key, embedding)
+
+        return embedding
+
+    def embed_query(self, text: str) -> list[float]:
+
+        key = self.query_key(text)
+        embedding = self.query_cache.get(key)
+
+        if embedding is None:
+            embedding = self.embedder.embed_query(text)
+            self.query_cache.put(key, embedding)
+
+        return embedding
+
+
+    async def lookup(self, hashes: set[str]) -> dict[str, list[float]]:
+
+        if not hashes:
+            return {}
+
+        try:
+            async with AsyncSessionLocal() as db:
+
+                result = await db.execute(
+                    select(EmbeddingCache.content_hash, EmbeddingCache.embedding)
+                    .where(EmbeddingCache.model == self.model, EmbeddingCache.content_hash.in_(hashes))
+                )
+                vectors = {row.content_hash: [float(x) for x in row.embedding] for row in result}
+
+                # keep hit rows young for age based eviction
+                if vectors:
+                    await db.execute(
+                        update(EmbeddingCache)
+                        .where(EmbeddingCache.model == self.model, EmbeddingCache.content_hash.in_(vectors.keys()))
+                        .values(last_used_at=func.now())
+                    )
+                    await db.commit()
+
+                return vectors
+
+        except SQLAlchemyError as e:
+            # cache is an optimization, a failing lookup falls back to the provider
+            backend_log.info(f'Exception while looking up embedding cache : {e}')
+            return {}
+
+
+    async def store(self, vectors: dict[str, list[float]]):
+
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    insert(EmbeddingCache)
+                    .values([{"model": self.model, "content_hash": text_hash, "embedding": vector} for text_hash, vector in vectors.items()])
+                    .on_conflict_do_nothing()
+                )
+                await db.commit()
+
+        except SQLAlchemyError as e:
+            backend_log.info(f'Exception while storing in embedding cache : {e}')
+
+
+    async def stats(self) -> EmbeddingCacheStats:
+
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(func.count()).select_from(EmbeddingCache).where(EmbeddingCache.model == self.model))
+            rows = result.scalar()
+
+        total = self.hits + self.misses
+        return EmbeddingCacheStats(
+            model=self.model,
+            rows=rows,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / total if total else 0.0,
+        )
+
+
+
+#--------- Batched embedding pipeline --------#
+@dataclass
+class DocEmbedProgress:
+    chunks: int = 0
+    pending: int = 0
+    failed: bool = False
+    started: float = 0.0
+    finished: float = 0.0
+    sealed: bool = False   # every chunk of the document has been added
+
+
+class EmbeddingPipeline:
+
+    # groups chunks of many documents into batches (by count and tokens), embeds several batches
+    # concurrently and inserts finished batches while the next ones are still being embedded.
+    # vector_store is anything with aadd_embeddings, a VectorStore or the COPY based VectorBulkLoader
+    def __init__(self, embedder: Embeddings, vector_store: VectorStore, batch_size: int = EMBED_BATCH_SIZE,
+                 batch_tokens: int = EMBED_BATCH_TOKENS, concurrency: int = EMBED_CONCURRENCY):
+
+        self.embedder = embedder
+        self.vector_store = vector_store
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.concurrency = concurrency
+
+        self.progress: dict[int, DocEmbedProgress] = {}
+        self.batch: list[LangChainDocument] = []
+        self.batch_token_count = 0
+
+        self.embedding = asyncio.Semaphore(concurrency)
+        self.embed_tasks: set[asyncio.Task] = set()
+        self.inserts: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+        self.insert_task = asyncio.create_task(self._insert_worker())
+
+        # ids of sealed documents whose chunks are all embedded and inserted (or failed)
+        self.completed: asyncio.Queue = asyncio.Queue()
+
+
+    # a document may be added in several parts (page ranges), its progress accumulates
+    async def add(self, doc_id: int, chunks: list[LangChainDocument]):
+
+        progress = self.progress.setdefault(doc_id, DocEmbedProgress(started=time.perf_counter()))
+        progress.chunks += len(chunks)
+        progress.pending += len(chunks)
+
+        for chunk in chunks:
+            chunk_tokens = count_tokens(chunk.page_content)
+
+            if self.batch and (len(self.batch) >= self.batch_size or self.batch_token_count + chunk_tokens > self.batch_tokens):
+                await self._flush()
+
+            self.batch.append(chunk)
+            self.batch_token_count += chunk_tokens
+
+
+    # no more chunks for this document, it completes once its pending chunks are done
+    def seal(self, doc_id: int, failed: bool = False):
+
+        progress = self.progress.setdefault(doc_id, DocEmbedProgress(started=time.perf_counter()))
+        progress.sealed = True
+        progress.failed = progress.failed or failed
+        self._complete(doc_id, progress)
+
+
+    def _complete(self, doc_id: int, progress: DocEmbedProgress):
+
+        if progress.sealed and progress.pending == 0:
+            progress.finished = time.perf_counter()
+            self.completed.put_nowait(doc_id)
+
+
+    async def _flush(self):
+
+        batch, self.batch, self.batch_token_count = self.batch, [], 0
+
+        # backpressure : never keep more than 2x concurrency batches in flight
+        while len(self.embed_tasks) >= 2 * self.concurrency:
+            done, self.embed_tasks = await asyncio.wait(self.embed_tasks, return_when=asyncio.FIRST_COMPLETED)
+
+        self.embed_tasks.add(asyncio.create_task(self._embed_batch(batch)))
+
+
+    async def _embed_batch(self, batch: list[LangChainDocument]):
+
+        try:
+            async with self.embedding:
+                vectors = await self.embedder.aembed_documents([chunk.page_content for chunk in batch])
+
+        except Exception as e:
+            backend_log.info(f'Exception while embedding batch of {len(batch)} chunks : {e}')
+            self._done(batch, failed=True)
+            return
+
+        await self.inserts.put((batch, vectors))
+
+
+    async def _insert_worker(self):
+
+        while (item := await self.inserts.get()) is not None:
+
+            batch, vectors = item
+            try:
+                await self.vector_store.aadd_embeddings(
+                    texts=[chunk.page_content for chunk in batch],
+                    embeddings=vectors,
+                    metadatas=[chunk.metadata for chunk in batch],
+                )
+                self._done(batch)
+
+            except Exception as e:
+                backend_log.info(f'Exception while inserting batch of {len(batch)} vectors : {e}')
+                self._done(batch, failed=True)
+
+
+    def _done(self, batch: list[LangChainDocument], failed: bool = False):
+
+        for chunk in batch:
+            progress = self.progress[chunk.metadata["doc_id"]]
+            progress.pending -= 1
+            progress.failed = progress.failed or failed
+
+            if progress.pending == 0:
+                self._complete(chunk.metadata["doc_id"], progress)
+
+
+    async def finish(self) -> dict[int, DocEmbedProgress]:
+
+        if self.batch:
+            await self._flush()
+
+        if self.embed_tasks:
+            await asyncio.wait(self.embed_tasks)
+
+        await self.inserts.put(None)
+        await self.insert_task
+
+        return self.progress
+
+
+    # stops background work of a pipeline abandoned before finish
+    def cancel(self):
+        for task in [*self.embed_tasks, self.insert_task]:
+            task.cancel()
+
+
+
+#--------- Cache eviction --------#
+async def evict_embedding_cache(max_rows: int, max_age_days: int) -> int:
+
+    evicted = 0
+
+    try:
+        async with AsyncSessionLocal() as db:
+
+            # age based : drop vectors not used for max_age_days
+            if max_age_days:
+                cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+                result = await db.execute(delete(EmbeddingCache).where(EmbeddingCache.last_used_at < cutoff))
+                evicted += result.rowcount
+
+            # size based : keep only the max_rows most recently used vectors
+            if max_rows:
+                keep = (
+                    select(EmbeddingCache.last_used_at)
+                    .order_by(EmbeddingCache.last_used_at.desc())
+                    .offset(max_rows - 1)
+                    .limit(1)
+                    .scalar_subquery()
+                )
+                result = await db.execute(delete(EmbeddingCache).where(EmbeddingCache.last_used_at < keep))
+                evicted += result.rowcount
+
+            await db.commit()
+
+    except SQLAlchemyError as e:
+        backend_log.info(f'Exception while evicting embedding cache : {e}')
+
+    backend_log.info(f'Embedding cache eviction removed {evicted} vectors')
+    return evicted
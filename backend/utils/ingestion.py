@@ -0,0 +1,272 @@
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import select, update, and_, or_, func
+from datetime import datetime, timedelta, timezone
+import asyncio
+import psycopg
+import time
+import os
+
+from commons import db_dependency, AsyncSessionLocal, backend_log
+from models import Document, IngestionJob, IngestionJobDocument
+from schema import *
+from utils import document
+
+
+
+# jobs one worker process runs at once, documents of a job share one embedding pipeline
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", 2))
+
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", 2))
+INGEST_HEARTBEAT_SECONDS = int(os.getenv("INGEST_HEARTBEAT_SECONDS", 15))
+
+# a running job without heartbeat for this long lost its worker and is claimed again
+INGEST_STALE_SECONDS = int(os.getenv("INGEST_STALE_SECONDS", 120))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", 3))
+
+
+
+#--------- Enqueue --------#
+async def enqueue(doc_ids: list[int], embedding_model: str | None, db: db_dependency) -> IngestionJob:
+
+    try:
+        job = IngestionJob(embedding_model=document.embedding_model_name(embedding_model), doc_ids=list(doc_ids))
+        db.add(job)
+        await db.flush()
+
+        db.add_all([IngestionJobDocument(job_id=job.id, doc_id=doc_id) for doc_id in dict.fromkeys(doc_ids)])
+        await db.commit()
+
+        backend_log.info(f'Ingestion job {job.id} queued for {len(doc_ids)} documents with {job.embedding_model}')
+        return job
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Rollback in case of error
+        raise Exception(f"Error while queueing ingestion job: {e}")
+
+
+
+#--------- Job status --------#
+async def job_status(job_id: int, db: db_dependency) -> IngestionJobStatus | None:
+
+    job = await db.get(IngestionJob, job_id)
+    if job is None:
+        return None
+
+    result = await db.execute(select(IngestionJobDocument).where(IngestionJobDocument.job_id == job_id).order_by(IngestionJobDocument.doc_id))
+    documents = result.scalars().all()
+
+    counts = {status: sum(1 for doc in documents if doc.status == status) for status in ("pending", "running", "done", "failed")}
+    chunks = sum(doc.chunks for doc in documents if doc.status == "done")
+
+    elapsed = 0.0
+    if job.started_at:
+        elapsed = ((job.finished_at or datetime.now(timezone.utc)) - job.started_at).total_seconds()
+
+    return IngestionJobStatus(
+        id=job.id,
+        status=job.status,
+        embedding_model=job.embedding_model,
+        attempts=job.attempts,
+        workers=document.PARSE_WORKERS,
+        error=job.error,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+        total=len(documents),
+        chunks=chunks,
+        elapsed_seconds=elapsed,
+        docs_per_second=counts["done"] / elapsed if elapsed else 0.0,
+        chunks_per_second=chunks / elapsed if elapsed else 0.0,
+        documents=[IngestionDocStatus.model_validate(doc) for doc in documents],
+        **counts,
+    )
+
+
+
+#--------- Claim --------#
+
+# FOR UPDATE SKIP LOCKED : concurrent workers never claim the same job and never wait on each other
+async def claim(worker_id: str) -> int | None:
+
+    stale = datetime.now(timezone.utc) - timedelta(seconds=INGEST_STALE_SECONDS)
+
+    async with AsyncSessionLocal() as db:
+
+        # jobs which lost their worker too often are given up
+        await db.execute(
+            update(IngestionJob)
+            .where(IngestionJob.status == "running", IngestionJob.heartbeat_at < stale, IngestionJob.attempts >= INGEST_MAX_ATTEMPTS)
+            .values(status="failed", error="worker lost too many times", finished_at=func.now())
+        )
+
+        result = await db.execute(
+            select(IngestionJob)
+            .where(or_(
+                IngestionJob.status == "queued",
+                and_(IngestionJob.status == "running", IngestionJob.heartbeat_at < stale),
+            ))
+            .order_by(IngestionJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        job = result.scalars().first()
+
+        if job is None:
+            await db.commit()
+            return None
+
+        job.status = "running"
+        job.worker_id = worker_id
+        job.attempts += 1
+        job.started_at = job.started_at or func.now()
+        job.heartbeat_at = func.now()
+        await db.commit()
+
+        return job.id
+
+
+
+#--------- Run --------#
+async def checkpoint(job_id: int, doc_id: int, **values):
+
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(IngestionJobDocument)
+            .where(IngestionJobDocument.job_id == job_id, IngestionJobDocument.doc_id == doc_id)
+            .values(**values)
+        )
+        await db.commit()
+
+
+async def heartbeat(job_id: int):
+
+    while True:
+        await asyncio.sleep(INGEST_HEARTBEAT_SECONDS)
+
+        # a missed beat is fine, a dead heartbeat task would let another worker reclaim a job still running here
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(update(IngestionJob).where(IngestionJob.id == job_id).values(heartbeat_at=func.now()))
+                await db.commit()
+
+        except (SQLAlchemyError, OSError) as e:
+            backend_log.info(f'Ingestion job {job_id} : heartbeat failed : {e}')
+
+
+async def run_job(job_id: int):
+
+    beat = asyncio.create_task(heartbeat(job_id))
+
+    try:
+        async with AsyncSessionLocal() as db:
+
+            job = await db.get(IngestionJob, job_id)
+
+            # documents finished by an earlier attempt are not processed again
+            result = await db.execute(
+                select(IngestionJobDocument.doc_id)
+                .where(IngestionJobDocument.job_id == job_id, IngestionJobDocument.status != "done")
+            )
+            pending_ids = set(result.scalars().all())
+
+            result = await db.execute(select(Document).where(Document.id.in_(pending_ids)))
+            docs = result.scalars().all()
+
+            # vectors committed by a lost attempt right before its checkpoint
+            embedded_ids = await document.fetch_embedded_doc_ids(db, document.collection_name(job.embedding_model))
+
+            # untagged chunks of older builds can't be filtered, drop them
+            await document.delete_vectors(set(), db)
+
+        for doc_id in pending_ids - {doc.id for doc in docs}:
+            await checkpoint(job_id, doc_id, status="failed", error="document no longer in library")
+
+        already_embedded = [doc.id for doc in docs if doc.id in embedded_ids]
+        for doc_id in already_embedded:
+            await checkpoint(job_id, doc_id, status="done")
+        await document.set_ingestion_state(job.embedding_model, "embedded", already_embedded)
+
+        to_embed = [doc for doc in docs if doc.id not in embedded_ids]
+        added = []
+
+        for doc in to_embed:
+            await checkpoint(job_id, doc.id, status="running")
+
+        # documents are checkpointed one by one as they are published, a reclaimed job resumes after them
+        async def done(timing: DocTiming):
+            await checkpoint(
+                job_id, timing.id,
+                status="done" if timing.success else "failed",
+                chunks=timing.chunks,
+                parse_seconds=timing.parse_seconds,
+                embed_seconds=timing.embed_seconds,
+                error=None if timing.success else "parsing or embedding failed",
+            )
+            if timing.success:
+                added.append(timing.id)
+
+        # one pipeline for the whole job : parsing uses the whole pool and batches mix chunks of every document
+        if to_embed:
+            await document.embed_documents(to_embed, job.embedding_model, on_document=done)
+
+        async with AsyncSessionLocal() as db:
+            await document.finish_build(db, added)
+
+            result = await db.execute(
+                select(func.count())
+                .select_from(IngestionJobDocument)
+                .where(IngestionJobDocument.job_id == job_id, IngestionJobDocument.status != "done")
+            )
+            failed = result.scalar()
+
+            await db.execute(
+                update(IngestionJob)
+                .where(IngestionJob.id == job_id)
+                .values(
+                    status="failed" if failed else "done",
+                    error=f"{failed} documents failed" if failed else None,
+                    finished_at=func.now(),
+                )
+            )
+            await db.commit()
+
+        backend_log.info(f'Ingestion job {job_id} finished : {len(added)} documents embedded, {failed} failed')
+
+    except (SQLAlchemyError, psycopg.Error) as e:
+        # the job stays running, once its heartbeat is stale another worker picks it up from its checkpoints
+        backend_log.info(f'Ingestion job {job_id} interrupted : {e}')
+
+    finally:
+        beat.cancel()
+
+
+
+#--------- Worker --------#
+async def worker_loop(worker_id: str):
+
+    while True:
+        try:
+            job_id = await claim(worker_id)
+        except SQLAlchemyError as e:
+            backend_log.info(f'Worker {worker_id} could not claim a job : {e}')
+            job_id = None
+
+        if job_id is None:
+            await asyncio.sleep(INGEST_POLL_SECONDS)
+            continue
+
+        started = time.perf_counter()
+        backend_log.info(f'Worker {worker_id} claimed ingestion job {job_id}')
+
+        try:
+            await run_job(job_id)
+        except Exception as e:
+            # the worker keeps serving, the job is picked up again once its heartbeat is stale
+            backend_log.info(f'Ingestion job {job_id} crashed : {e}')
+            continue
+
+        backend_log.info(f'Worker {worker_id} done with ingestion job {job_id} in {time.perf_counter() - started:.1f}s')
+
+
+async def run_worker(worker_id: str, concurrency: int = INGEST_CONCURRENCY):
+    await asyncio.gather(*[worker_loop(f"{worker_id}/{slot}") for slot in range(concurrency)])
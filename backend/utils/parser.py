@@ -0,0 +1,169 @@
+from langchain_community.document_loaders import Docx2txtLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document as LangChainDocument
+from collections.abc import Iterator
+from pypdf import PdfReader
+from pathlib import Path
+import hashlib
+import shutil
+import gzip
+import json
+import time
+import uuid
+import os
+
+# This module runs inside parse pool worker processes, keep it free of DB / API clients.
+
+
+# pages parsed by one pool task, memory of a parse is bounded by this range instead of the document size
+PARSE_PAGE_BATCH = int(os.getenv("PARSE_PAGE_BATCH", 50))
+
+# chunking settings, changing them only re-splits the cached text of each document
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1000))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 200))
+
+# extracted text of every page is kept gzipped under library/.text/<sha256 of the file>,
+# files never change after upload so later parses read it instead of the binary
+TEXT_CACHE = os.getenv("TEXT_CACHE", "true").lower() == "true"
+TEXT_CACHE_COMPRESSLEVEL = int(os.getenv("TEXT_CACHE_COMPRESSLEVEL", 6))
+
+# initiate Objects 
+splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, length_function=len, add_start_index=True)
+
+project_root = Path(__file__).resolve().parents[1]  # adjust level depending on nesting
+library_path = project_root / "library"
+text_cache_path = library_path / ".text"
+
+
+
+#--------- Extracted text cache --------#
+def file_hash(file_name: str) -> str:
+
+    digest = hashlib.sha256()
+    with open(library_path / file_name, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def text_cache_dir(content_hash: str | None) -> Path | None:
+    return text_cache_path / content_hash if TEXT_CACHE and content_hash else None
+
+
+# parses of concurrent ranges, workers or containers (library/ is shared) may write the same file,
+# writes go through a uniquely named temp file and a rename
+def write_cached(path: Path, content: str):
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_name(f".{path.name}.{uuid.uuid4()}.part")
+
+    with gzip.open(partial_path, "wt", encoding="utf-8", compresslevel=TEXT_CACHE_COMPRESSLEVEL) as file:
+        file.write(content)
+
+    os.replace(partial_path, path)
+
+
+def read_cached(path: Path) -> str | None:
+
+    if not path.exists():
+        return None
+
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return file.read()
+
+
+def remove_text_cache(content_hash: str | None):
+
+    cache_dir = text_cache_dir(content_hash)
+    if cache_dir is not None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+
+#--------- Pages of a doc --------#
+def page_count(file_name: str, content_hash: str | None = None) -> int:
+
+    file_path = library_path / file_name
+    cache_dir = text_cache_dir(content_hash)
+
+    if cache_dir is not None and (cached := read_cached(cache_dir / "meta.json.gz")):
+        return json.loads(cached)["total_pages"]
+
+    if file_path.suffix == '.pdf':
+        total_pages = len(PdfReader(file_path).pages)
+
+    # docx has no pages, it is loaded as a single one
+    elif file_path.suffix == '.docx':
+        total_pages = 1
+
+    else:
+        return 0
+
+    if cache_dir is not None:
+        write_cached(cache_dir / "meta.json.gz", json.dumps({"name": file_name, "total_pages": total_pages}))
+
+    return total_pages
+
+
+# text of one page, from the cache when it was extracted before
+def page_text(file_path: Path, page: int, reader: PdfReader | None, cache_dir: Path | None) -> str:
+
+    cached_path = cache_dir / f"{page:05d}.txt.gz" if cache_dir is not None else None
+
+    if cached_path is not None and (content := read_cached(cached_path)) is not None:
+        return content
+
+    if file_path.suffix == '.pdf':
+        content = reader.pages[page].extract_text()
+    else:
+        content = "\n\n".join(doc.page_content for doc in Docx2txtLoader(file_path).lazy_load())
+
+    if cached_path is not None:
+        write_cached(cached_path, content)
+
+    return content
+
+
+# yields pages one at a time, only the pages of [start, stop) are ever extracted
+def lazy_pages(file_path: Path, start: int, stop: int, content_hash: str | None = None) -> Iterator[LangChainDocument]:
+
+    cache_dir = text_cache_dir(content_hash)
+
+    # with a cache the binary is only opened for pages missing from it
+    reader = PdfReader(file_path) if file_path.suffix == '.pdf' and cache_dir is None else None
+    total_pages = len(reader.pages) if reader is not None else page_count(file_path.name, content_hash)
+
+    for page in range(start, min(stop, total_pages)):
+
+        if reader is None and file_path.suffix == '.pdf' and (cache_dir is None or not (cache_dir / f"{page:05d}.txt.gz").exists()):
+            reader = PdfReader(file_path)
+
+        content = page_text(file_path, page, reader, cache_dir)
+
+        # same metadata as PyPDFLoader, page is 0 based
+        if file_path.suffix == '.pdf':
+            yield LangChainDocument(page_content=content, metadata={"source": str(file_path), "page": page, "total_pages": total_pages})
+        else:
+            yield LangChainDocument(page_content=content, metadata={"source": str(file_path)})
+
+
+
+#--------- Split doc in splits --------#
+def load_and_split(file_id: int, file_name: str, start: int = 0, stop: int | None = None, content_hash: str | None = None) -> tuple[list[LangChainDocument], float]:
+
+    started = time.perf_counter()
+    file_path = library_path / file_name
+    stop = stop if stop is not None else start + PARSE_PAGE_BATCH
+
+    doc_splits = []
+
+    # every page is split as it is read, then dropped
+    for page in lazy_pages(file_path, start, stop, content_hash):
+        for split in splitter.split_documents([page]):
+
+            # tag every chunk with its library id, so context can be diffed and removed per document
+            split.metadata["doc_id"] = file_id
+            doc_splits.append(split)
+
+    return doc_splits, time.perf_counter() - started
@@ -0,0 +1,200 @@
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document as LangChainDocument
+from pydantic import ConfigDict, BaseModel as PydanticBaseModel
+from sqlalchemy import text
+import hashlib
+import struct
+import os
+
+from commons import AsyncSessionLocal, LRUCache
+from utils.vector_index import TEXT_SEARCH_CONFIG, TEXT_SEARCH_EXISTS_SQL, VECTOR_RESCORE_FACTOR, search_distance
+
+
+
+# default ANN search settings, both can be overridden per query
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 40))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", 10))
+
+# pgvector >= 0.8 keeps scanning the index until enough rows pass the collection / document filter, empty disables
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "relaxed_order")
+
+# hybrid search fuses vector and full text rankings with reciprocal rank fusion
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+RRF_K = int(os.getenv("RRF_K", 60))
+
+# candidates taken from each ranking before fusion, per result
+HYBRID_FETCH_FACTOR = int(os.getenv("HYBRID_FETCH_FACTOR", 4))
+
+# in-process LRU of search results, cleared whenever this process rebuilds context,
+# other processes miss on the context version which is part of the key
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 5_000))
+retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE)
+
+
+
+def to_pgvector(embedding: list[float]) -> str:
+    return "[" + ",".join(map(str, embedding)) + "]"
+
+
+def vector_hash(embedding: list[float]) -> str:
+    return hashlib.sha256(struct.pack(f"{len(embedding)}d", *embedding)).hexdigest()
+
+
+
+#--------- pgvector retriever --------#
+class PGVectorRetriever(PydanticBaseModel):
+
+    # cosine similarity search over one collection, restricted to the selected documents,
+    # with ANN search params set for the query transaction. queries are embedded by the caller (see asearch)
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    embedder: Embeddings
+    collection_name: str
+    k: int = 2
+    doc_ids: list[int] | None = None
+    ef_search: int = HNSW_EF_SEARCH
+    probes: int = IVFFLAT_PROBES
+    context_version: int | None = None   # results are only cached when the context version is known
+    hybrid: bool = HYBRID_SEARCH
+    rrf_k: int = RRF_K
+
+
+    def cache_key(self, embedding: list[float], query: str | None) -> tuple:
+        doc_ids = tuple(sorted(self.doc_ids)) if self.doc_ids is not None else None
+        query = " ".join(query.lower().split()) if query else None
+        return (self.collection_name, vector_hash(embedding), query, self.k, doc_ids, self.ef_search, self.probes, self.context_version)
+
+
+    # search with an already embedded query, the query text adds the lexical ranking
+    async def asearch(self, embedding: list[float], query: str | None = None) -> list[LangChainDocument]:
+
+        if self.doc_ids is not None and not self.doc_ids:
+            return []
+
+        query = query if self.hybrid else None
+
+        if self.context_version is None:
+            return await self._search(embedding, query)
+
+        key = self.cache_key(embedding, query)
+        docs = retrieval_cache.get(key)
+
+        if docs is None:
+            docs = await self._search(embedding, query)
+            retrieval_cache.put(key, docs)
+
+        # callers may annotate metadata, never hand out the cached objects
+        return [doc.model_copy(deep=True) for doc in docs]
+
+
+    # candidates come from the ANN index (possibly half precision / binary) and are ranked by full precision distance
+    def vector_sql(self, doc_filter: str) -> str:
+        return f"""
+        SELECT document, cmetadata, distance
+        FROM (
+            SELECT e.document, e.cmetadata, e.embedding <=> CAST(:embedding AS vector) AS distance
+            FROM langchain_pg_embedding e
+            JOIN langchain_pg_collection c ON c.uuid = e.collection_id
+            WHERE c.name = :collection {doc_filter}
+            ORDER BY {search_distance()}
+            LIMIT :vector_candidates
+        ) candidates
+        ORDER BY distance
+        LIMIT :k
+        """
+
+
+    # both rankings run as CTEs of one statement and are fused with reciprocal rank fusion,
+    # the lexical query ORs the question terms so a single exact identifier is enough to match
+    def hybrid_sql(self, doc_filter: str) -> str:
+        return f"""
+        WITH vector_hits AS (
+            SELECT id, row_number() OVER (ORDER BY distance) AS rank
+            FROM (
+                SELECT e.id, e.embedding <=> CAST(:embedding AS vector) AS distance
+                FROM langchain_pg_embedding e
+                JOIN langchain_pg_collection c ON c.uuid = e.collection_id
+                WHERE c.name = :collection {doc_filter}
+                ORDER BY {search_distance()}
+                LIMIT :vector_candidates
+            ) nearest
+        ),
+        lexical_hits AS (
+            SELECT e.id, row_number() OVER (ORDER BY ts_rank_cd(e.document_tsv, q.query) DESC) AS rank
+            FROM langchain_pg_embedding e
+            JOIN langchain_pg_collection c ON c.uuid = e.collection_id,
+            LATERAL (
+                SELECT nullif(replace(plainto_tsquery(CAST(:ts_config AS regconfig), :query)::text, '&', '|'), '')::tsquery AS query
+            ) q
+            WHERE c.name = :collection AND e.document_tsv @@ q.query {doc_filter}
+            ORDER BY ts_rank_cd(e.document_tsv, q.query) DESC
+            LIMIT :candidates
+        )
+        SELECT e.document, e.cmetadata, e.embedding <=> CAST(:embedding AS vector) AS distance,
+               v.rank AS vector_rank, l.rank AS lexical_rank,
+               coalesce(1.0 / (:rrf_k + v.rank), 0) + coalesce(1.0 / (:rrf_k + l.rank), 0) AS rrf
+        FROM vector_hits v
+        FULL OUTER JOIN lexical_hits l ON l.id = v.id
+        JOIN langchain_pg_embedding e ON e.id = coalesce(v.id, l.id)
+        ORDER BY rrf DESC
+        LIMIT :k
+        """
+
+
+    async def _search(self, embedding: list[float], query: str | None = None) -> list[LangChainDocument]:
+
+        doc_filter = "AND (e.cmetadata->>'doc_id')::int = ANY(:doc_ids)" if self.doc_ids is not None else ""
+
+        params = {"embedding": to_pgvector(embedding), "collection": self.collection_name, "k": self.k, "doc_ids": self.doc_ids,
+                  "vector_candidates": self.k * VECTOR_RESCORE_FACTOR}
+        if query:
+            candidates = self.k * HYBRID_FETCH_FACTOR
+            params.update(query=query, ts_config=TEXT_SEARCH_CONFIG, rrf_k=self.rrf_k, candidates=candidates,
+                          vector_candidates=candidates * VECTOR_RESCORE_FACTOR)
+
+        # hnsw returns at most ef_search rows, the candidate pool must fit
+        settings = {"ef_search": str(max(self.ef_search, params["vector_candidates"])), "probes": str(self.probes), "iterative_scan": HNSW_ITERATIVE_SCAN}
+        iterative_scan = "set_config('hnsw.iterative_scan', :iterative_scan, true)," if HNSW_ITERATIVE_SCAN else ""
+
+        async with AsyncSessionLocal() as db:
+
+            # is_local settings only live for this transaction, pooled connections keep their defaults.
+            # ivfflat reads probes when the index scan is initialized, before any expression of the search statement
+            # is evaluated, so the settings go in one statement ahead of it which also checks for the full text column
+            result = await db.execute(text(f"""
+                SELECT set_config('hnsw.ef_search', :ef_search, true),
+                       set_config('ivfflat.probes', :probes, true),
+                       {iterative_scan}
+                       {TEXT_SEARCH_EXISTS_SQL} AS text_search
+            """), settings)
+
+            # vectors committed before the full text column exists are still searched, by vector only
+            if query and not result.one().text_search:
+                query = None
+                params["vector_candidates"] = self.k * VECTOR_RESCORE_FACTOR
+
+            sql = self.hybrid_sql(doc_filter) if query else self.vector_sql(doc_filter)
+            result = await db.execute(text(sql), params)
+            rows = result.all()
+
+        if not query:
+            # relaxed iterative scans may return rows slightly out of order
+            rows = sorted(rows, key=lambda row: row.distance)
+            return [
+                LangChainDocument(page_content=row.document, metadata={**(row.cmetadata or {}), "score": 1 - row.distance})
+                for row in rows
+            ]
+
+        return [
+            LangChainDocument(
+                page_content=row.document,
+                metadata={
+                    **(row.cmetadata or {}),
+                    "score": 1 - row.distance,
+                    "rrf": float(row.rrf),
+                    "vector_rank": row.vector_rank,
+                    "lexical_rank": row.lexical_rank,
+                },
+            )
+            for row in rows
+        ]
@@ -0,0 +1,16 @@
+from functools import lru_cache
+import tiktoken
+
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # models newer than the installed tiktoken
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(content: str, model: str) -> int:
+    return len(get_encoding(model).encode(content, disallowed_special=()))
@@ -0,0 +1,224 @@
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import text
+import math
+import os
+
+from commons import db_dependency, async_engine, backend_log
+from schema import EmbeddingModelName
+
+
+
+# full length of the vectors of each model, text-embedding-3 models return shortened vectors natively
+NATIVE_DIMENSIONS = {
+    EmbeddingModelName.TXT_EMBDG_3_SMALL.value: 1536,
+    EmbeddingModelName.TXT_EMBDG_3_LARGE.value: 3072,
+}
+
+# every model is asked for vectors of this length (one typed column and ANN index for all collections),
+# changing it re-embeds every document
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", NATIVE_DIMENSIONS[EmbeddingModelName.TXT_EMBDG_3_SMALL.value]))
+
+# ANN index storage : full precision, half precision or binary quantized vectors. compact indexes fetch
+# VECTOR_RESCORE_FACTOR x k candidates which are re-scored with the full precision vectors of the table
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "vector")  # vector | halfvec | binary
+VECTOR_RESCORE_FACTOR = int(os.getenv("VECTOR_RESCORE_FACTOR", 1 if VECTOR_STORAGE == "vector" else 4))
+
+# ANN index settings for langchain_pg_embedding
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "hnsw")  # hnsw | ivfflat
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 64))
+
+INDEX_NAME = "langchain_pg_embedding_ann_idx"
+
+# replacement indexes are built concurrently under this name and swapped in once valid
+BUILD_INDEX_NAME = f"{INDEX_NAME}_build"
+
+# full text search over chunk text for hybrid retrieval, the config is baked into the generated column
+TEXT_SEARCH_CONFIG = os.getenv("TEXT_SEARCH_CONFIG", "english")
+
+# lexical side of hybrid retrieval, kept in sync with the chunk text by postgres. created with the tables by the
+# bulk loader (vectors are never visible without it) and checked again by index maintenance
+TEXT_SEARCH_COLUMN_SQL = f"""
+    ALTER TABLE langchain_pg_embedding ADD COLUMN IF NOT EXISTS document_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('{TEXT_SEARCH_CONFIG}'::regconfig, coalesce(document, ''))) STORED
+"""
+TEXT_SEARCH_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS langchain_pg_embedding_tsv_idx
+    ON langchain_pg_embedding USING gin (document_tsv)
+"""
+TEXT_SEARCH_EXISTS_SQL = """
+    EXISTS (
+        SELECT 1 FROM pg_attribute
+        WHERE attrelid = to_regclass('langchain_pg_embedding') AND attname = 'document_tsv' AND NOT attisdropped
+    )
+"""
+
+
+
+async def vector_table_exists(db: db_dependency) -> bool:
+    result = await db.execute(text("SELECT to_regclass('langchain_pg_embedding') IS NOT NULL"))
+    return result.scalar()
+
+
+
+# indexed expression and operator class of the ANN index for a storage mode
+def index_expression(storage: str = VECTOR_STORAGE, dimensions: int = EMBEDDING_DIMENSIONS) -> tuple[str, str]:
+
+    if storage == "halfvec":
+        return f"(embedding::halfvec({dimensions}))", "halfvec_cosine_ops"
+
+    if storage == "binary":
+        return f"(binary_quantize(embedding)::bit({dimensions}))", "bit_hamming_ops"
+
+    return "embedding", "vector_cosine_ops"
+
+
+# ORDER BY distance matching the index expression, so the planner can use the ANN index
+def search_distance(storage: str = VECTOR_STORAGE, dimensions: int = EMBEDDING_DIMENSIONS, column: str = "e.embedding", query: str = ":embedding") -> str:
+
+    if storage == "halfvec":
+        return f"{column}::halfvec({dimensions}) <=> CAST({query} AS halfvec({dimensions}))"
+
+    if storage == "binary":
+        return f"binary_quantize({column})::bit({dimensions}) <~> binary_quantize(CAST({query} AS vector))"
+
+    return f"{column} <=> CAST({query} AS vector)"
+
+
+
+async def stored_dimensions(db: db_dependency) -> int | None:
+    result = await db.execute(text("SELECT vector_dims(embedding) FROM langchain_pg_embedding LIMIT 1"))
+    return result.scalar()
+
+
+# ANN indexes need a fixed dimension, tables created by older builds have an untyped vector column.
+# vectors of another dimension are never dropped here, that takes the explicit migration
+# (scripts/migrate_embedding_dimensions.py) which also resets the ingestion state of the library
+async def ensure_vector_dimensions(db: db_dependency) -> bool:
+
+    stored = await stored_dimensions(db)
+
+    if stored is not None and stored != EMBEDDING_DIMENSIONS:
+        backend_log.info(f'Stored vectors have {stored} dimensions, {EMBEDDING_DIMENSIONS} configured : run scripts.migrate_embedding_dimensions, ANN index left as is')
+        return False
+
+    result = await db.execute(text("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = 'langchain_pg_embedding'::regclass AND attname = 'embedding'
+    """))
+
+    if result.scalar() != f'vector({EMBEDDING_DIMENSIONS})':
+        backend_log.info(f'Fixing embedding column dimension to {EMBEDDING_DIMENSIONS}')
+        await db.execute(text(f"ALTER TABLE langchain_pg_embedding ALTER COLUMN embedding TYPE vector({EMBEDDING_DIMENSIONS})"))
+
+    return True
+
+
+
+# ivfflat lists as recommended by pgvector : rows / 1000 up to 1M rows, sqrt(rows) above
+def ivfflat_lists(rows: int) -> int:
+    return max(1, rows // 1000 if rows <= 1_000_000 else int(math.sqrt(rows)))
+
+
+async def current_ivfflat_lists(db: db_dependency) -> int | None:
+
+    result = await db.execute(text("""
+        SELECT option_value::int FROM pg_class c, pg_options_to_table(c.reloptions)
+        WHERE c.relname = :index AND option_name = 'lists'
+    """), {"index": INDEX_NAME})
+
+    return result.scalar()
+
+
+async def current_index_definition(db: db_dependency) -> str | None:
+    result = await db.execute(text("SELECT indexdef FROM pg_indexes WHERE indexname = :index"), {"index": INDEX_NAME})
+    return result.scalar()
+
+
+
+#--------- Create / maintain ANN index --------#
+async def rebuild_ann_index(db: db_dependency, using: str):
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction and waits for every open transaction on the table,
+    # the session's own included : the session commits and the build runs on an autocommit connection
+    await db.commit()
+
+    async with async_engine.execution_options(isolation_level="AUTOCOMMIT").connect() as conn:
+        # invalid leftover of an interrupted build
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {BUILD_INDEX_NAME}"))
+        await conn.execute(text(f"CREATE INDEX CONCURRENTLY {BUILD_INDEX_NAME} ON langchain_pg_embedding {using}"))
+
+    # the swap is one short transaction, retrieval keeps the old index until the new one replaces it
+    await db.execute(text(f"DROP INDEX IF EXISTS {INDEX_NAME}"))
+    await db.execute(text(f"ALTER INDEX {BUILD_INDEX_NAME} RENAME TO {INDEX_NAME}"))
+    await db.commit()
+
+
+async def maintain_ann_index(db: db_dependency):
+
+    expression, opclass = index_expression()
+    definition = await current_index_definition(db)
+    using = None
+
+    # index type or storage mode changed since the index was built
+    changed = definition is not None and (f"USING {VECTOR_INDEX} " not in definition or opclass not in definition)
+    if changed:
+        backend_log.info(f'Rebuilding ANN index as {VECTOR_INDEX} over {VECTOR_STORAGE} (was {definition})')
+
+    if VECTOR_INDEX == "ivfflat":
+
+        # ivfflat centroids are computed at build time, rebuild once the table has outgrown them
+        result = await db.execute(text("SELECT count(*) FROM langchain_pg_embedding"))
+        lists = ivfflat_lists(result.scalar())
+        current = await current_ivfflat_lists(db)
+
+        if changed or current is None or not (current / 2 <= lists <= current * 2):
+            backend_log.info(f'Rebuilding ivfflat index with {lists} lists (was {current})')
+            using = f"USING ivfflat ({expression} {opclass}) WITH (lists = {lists})"
+
+    # hnsw is maintained incrementally on insert, it only has to exist
+    elif changed or definition is None:
+        using = f"USING hnsw ({expression} {opclass}) WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+
+    if using:
+        await rebuild_ann_index(db, using)
+
+
+async def ensure_vector_index(db: db_dependency) -> bool:
+
+    try:
+        if not await vector_table_exists(db):
+            return False
+
+        # the ANN index needs every stored vector at the configured dimension
+        dimensions_match = await ensure_vector_dimensions(db)
+
+        # lexical side of hybrid retrieval, normally created by the bulk loader. the ALTER takes an exclusive
+        # lock on the table even when the column exists, so like the loader it only runs when the column is missing
+        result = await db.execute(text(f"SELECT {TEXT_SEARCH_EXISTS_SQL}"))
+        if not result.scalar():
+            await db.execute(text(TEXT_SEARCH_COLUMN_SQL))
+            await db.execute(text(TEXT_SEARCH_INDEX_SQL))
+
+        # metadata filter used for context diffs and per document deletes
+        await db.execute(text("""
+            CREATE INDEX IF NOT EXISTS langchain_pg_embedding_doc_id_idx
+            ON langchain_pg_embedding (((cmetadata->>'doc_id')::int))
+        """))
+
+        await db.commit()
+
+        # built concurrently, after the DDL above is committed
+        if dimensions_match:
+            await maintain_ann_index(db)
+
+        # refresh planner statistics after bulk loads
+        await db.execute(text("ANALYZE langchain_pg_embedding"))
+        await db.commit()
+
+        return dimensions_match
+
+    except SQLAlchemyError as e:
+        await db.rollback()
+        backend_log.info(f'Exception while maintaining vector index : {e}')
+        return False
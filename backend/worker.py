@@ -0,0 +1,30 @@
+# Ingestion worker : claims build_context jobs from postgres and parses / embeds their documents.
+# Run as many of these as needed next to the API, e.g. `python worker.py`
+
+import asyncio
+import socket
+import os
+
+from utils import ingestion, document
+from commons import Base, engine, add_missing_columns, backend_log
+
+
+async def main():
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    backend_log.info(f'Ingestion worker {worker_id} started with {ingestion.INGEST_CONCURRENCY} job slots')
+
+    try:
+        await ingestion.run_worker(worker_id)
+    finally:
+        # stop document parse workers
+        document.parse_pool.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+
+    # Create Tables in PostgresDB if they already dont exist
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+
+    asyncio.run(main())
@@ -29,6 +29,9 @@ if "messages" not in st.session_state:
 if "session_id" not in st.session_state:
     st.session_state.session_id = None
 
+if "doc_ids" not in st.session_state:
+    st.session_state.doc_ids = None
+
 
 
 backend_log.info(f' Session state is  : {st.session_state}')
@@ -45,25 +48,28 @@ if prompt := st.chat_input("Query:"):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    with st.spinner("Generating response..."):
-        response = chat_api.send_message(
+    with st.chat_message("assistant"):
+
+        # render tokens as they are streamed from backend
+        result = {}
+        answer = st.write_stream(chat_api.stream_message(
             st.session_state.session_id,
             prompt,
             st.session_state.model,
             st.session_state.persona,
-        )
-        
-        if response:
-            st.session_state.session_id = response.get('session_id')
-            st.session_state.messages.append({"role": "assistant", "content": response['answer']})
-            
-            with st.chat_message("assistant"):
-                st.markdown(response['answer'])
-                
-                with st.expander("Details"):
-                    st.subheader("Generated Answer")
-                    st.code(response['answer'])
-                    st.subheader("Session ID")
-                    st.code(response['session_id'])
+            result,
+            st.session_state.doc_ids,
+            st.session_state.embedding_model,
+        ))
+
+        if answer and result.get('session_id'):
+            st.session_state.session_id = result['session_id']
+            st.session_state.messages.append({"role": "assistant", "content": answer})
+
+            with st.expander("Details"):
+                st.subheader("Generated Answer")
+                st.code(answer)
+                st.subheader("Session ID")
+                st.code(result['session_id'])
         else:
             st.error("Failed to get a response from the API. Please try again.")
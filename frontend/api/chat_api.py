@@ -3,9 +3,10 @@ from commons import backend_log
 
 
 URL = "http://backend:8000/conversation/"
+STREAM_URL = "http://backend:8000/conversation/stream"
 
 
-def send_message(session_id, question, model, persona):
+def send_message(session_id, question, model, persona, doc_ids=None, embedding_model=None):
     
     headers = {'accept': 'application/json','Content-Type': 'application/json'}
 
@@ -18,6 +19,14 @@ def send_message(session_id, question, model, persona):
     if session_id:
         data["session_id"] = session_id
 
+    # documents this session retrieves from, backend falls back to the active library context
+    if doc_ids is not None:
+        data["doc_ids"] = doc_ids
+
+    # retrieve from the collection built with this embedding model
+    if embedding_model:
+        data["embedding_model"] = embedding_model
+
 
     backend_log.info(f'The Payload for conversation is : {data}')
 
@@ -36,3 +45,65 @@ def send_message(session_id, question, model, persona):
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
         return None
+
+
+
+def stream_message(session_id, question, model, persona, result: dict, doc_ids=None, embedding_model=None):
+    
+    # yields answer tokens as they arrive, session_id of the turn is written into result once stream ends
+    headers = {'accept': 'text/event-stream','Content-Type': 'application/json'}
+
+    data = {
+        "question": question,
+        "model": model,
+        "persona" : persona
+    }
+
+    if session_id:
+        data["session_id"] = session_id
+
+    # documents this session retrieves from, backend falls back to the active library context
+    if doc_ids is not None:
+        data["doc_ids"] = doc_ids
+
+    # retrieve from the collection built with this embedding model
+    if embedding_model:
+        data["embedding_model"] = embedding_model
+
+
+    backend_log.info(f'The Payload for streamed conversation is : {data}')
+
+    try:
+
+        with requests.post(STREAM_URL, headers=headers, json=data, stream=True) as response:
+
+            if response.status_code != 200:
+                backend_log.info(f'Chat stream API failed : {response.status_code} | {response.text}')
+                st.error(f"API request failed with status code {response.status_code}: {response.text}")
+                return
+
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+
+                # blank line marks the end of an event
+                if not line:
+                    event = None
+                    continue
+
+                if line.startswith("event:"):
+                    event = line.removeprefix("event:").strip()
+
+                elif line.startswith("data:"):
+                    payload = json.loads(line.removeprefix("data:").strip())
+
+                    if event == "token":
+                        yield payload["token"]
+
+                    elif event == "done":
+                        result["session_id"] = payload["session_id"]
+
+                    elif event == "error":
+                        st.error(f"An error occurred while generating response: {payload['detail']}")
+
+    except Exception as e:
+        st.error(f"An error occurred: {str(e)}")
@@ -25,6 +25,26 @@ def upload(file):
         return None
 
 
+# every file in one request, the response has a result per file
+def upload_batch(files):
+
+    try:
+        endpoint = 'upload/batch'
+        url = urljoin(URL, endpoint)
+
+        files = [("files", (file.name, file, file.type)) for file in files]
+        response = requests.post(url, files=files)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            st.error(f"Failed to upload files. Error: {response.status_code} - {json.loads(response.text)['detail']}")
+            return None
+
+    except Exception as e:
+        st.error(f"An error occurred while uploading the files: {str(e)}")
+        return None
+
+
 def list_all():
     try:
         endpoint = 'list'
@@ -69,7 +89,33 @@ def delete(file_id):
     return None
 
 
-def build_context(file_ids: list[str]):
+def delete_batch(file_ids: list[int]):
+
+    headers = {
+        'accept': 'application/json',
+        'Content-Type': 'application/json'
+    }
+
+    data = {"ids": file_ids}
+
+    try:
+        endpoint = 'delete/batch'
+        url = urljoin(URL, endpoint)
+
+        response = requests.post(url=url,headers=headers,json=data)
+        if response.status_code == 200:
+            return response.json()
+
+        else:
+            st.error(f"Failed to delete documents. Error: {response.status_code} - {json.loads(response.text)['detail']}")
+
+    except Exception as e:
+        st.error(f"An error occurred while deleting the documents: {str(e)}")
+
+    return None
+
+
+def build_context(file_ids: list[str], embedding_model=None):
     
     headers = {
         'accept': 'application/json',
@@ -78,6 +124,10 @@ def build_context(file_ids: list[str]):
 
     data = {"ids": file_ids}
 
+    # vectors are built in (and later retrieved from) the collection of this embedding model
+    if embedding_model:
+        data["embedding_model"] = embedding_model
+
     try:
         endpoint = 'build_context'
         url = urljoin(URL, endpoint)
@@ -92,4 +142,23 @@ def build_context(file_ids: list[str]):
     except Exception as e:
         st.error(f"An error occurred while sending file_ids to Server: {str(e)}")
     
+    return None
+
+
+def build_status(job_id: int):
+
+    try:
+        endpoint = f'build_context/{job_id}'
+        url = urljoin(URL, endpoint)
+
+        response = requests.get(url)
+        if response.status_code == 200:
+            return response.json()
+
+        else:
+            st.error(f"Failed to fetch context build status. Error: {response.status_code} - {json.loads(response.text)['detail']}")
+
+    except Exception as e:
+        st.error(f"An error occurred while fetching context build status: {str(e)}")
+
     return None
\ No newline at end of file
@@ -1,7 +1,7 @@
 import streamlit as st
 import api.model_api as model_api, api.document_api as doc_api
 from commons import backend_log
-from datetime import time
+import time
 
 
 # Page title and config
@@ -38,6 +38,12 @@ if "messages" not in st.session_state:
 if "session_id" not in st.session_state:
     st.session_state.session_id = None
 
+if "doc_ids" not in st.session_state:
+    st.session_state.doc_ids = None
+
+if "build_job" not in st.session_state:
+    st.session_state.build_job = None
+
 
 #------- Define callback functions ---------#
 
@@ -113,7 +119,7 @@ if documents:
         "Select Documents to build context",
         options=[doc['id'] for doc in documents],
         format_func=lambda x: next(doc['name'] for doc in documents if doc['id'] == x),
-        default=[doc['id'] for doc in documents if doc['is_active'] == True],
+        default=st.session_state.doc_ids if st.session_state.doc_ids is not None else [doc['id'] for doc in documents if doc['is_active'] == True],
         )
 
     col1.markdown("<br>", unsafe_allow_html=True)
@@ -130,15 +136,53 @@ if documents:
 
     if selected_docs:
         # build context from selected documents
-        col1.info("Building context takes time, please wait after clicking build context button.", icon=":material/exclamation:")
+        col1.info("Context is built in the background, progress is shown below.", icon=":material/exclamation:")
         
-        if col1.button("Build Context", icon=":material/construction:"):
-            build_response = doc_api.build_context(selected_docs)
-            if build_response:
+        if col1.button("Build Context", icon=":material/construction:", disabled=st.session_state.build_job is not None):
+            build_response = doc_api.build_context(selected_docs, st.session_state.embedding_model)
+            if build_response and build_response["job_id"] is None:
+                # every selected document was ingested already
+                st.session_state.doc_ids = selected_docs
                 col1.success(f"{build_response["message"]}", icon=":material/check:")
+            elif build_response:
+                st.session_state.build_job = {"id": build_response["job_id"], "doc_ids": selected_docs}
             else:
                 col1.error(f"Context Build Failed !", icon=":material/close:")
 
+    # poll the ingestion job until it is finished
+    if st.session_state.build_job:
+        job = doc_api.build_status(st.session_state.build_job["id"])
+
+        if job:
+            finished = job["done"] + job["failed"]
+            col1.progress(
+                finished / job["total"] if job["total"] else 1.0,
+                text=f"{finished} of {job['total']} documents processed · {job['chunks']} chunks · {job['chunks_per_second']:.1f} chunks/s · {job['workers']} parse workers",
+            )
+
+            names = {doc['id']: doc['name'] for doc in documents}
+            col1.dataframe(
+                [{"document": names.get(doc["doc_id"], doc["doc_id"]), "status": doc["status"], "chunks": doc["chunks"],
+                  "parse s": round(doc["parse_seconds"], 2), "embed s": round(doc["embed_seconds"], 2)} for doc in job["documents"]],
+                hide_index=True,
+            )
+
+            if job["status"] in ("queued", "running"):
+                time.sleep(2)
+                st.rerun()
+
+            # this session now retrieves only from the selected documents
+            st.session_state.doc_ids = st.session_state.build_job["doc_ids"]
+            st.session_state.build_job = None
+
+            if job["status"] == "done":
+                col1.success(f"Context updated : {job['done']} documents embedded in {job['elapsed_seconds']:.1f}s", icon=":material/check:")
+            else:
+                col1.error(f"Context Build Failed : {job['error']}", icon=":material/close:")
+
+        else:
+            st.session_state.build_job = None
+
 else:
     col1.error("No Document in Library, Add documents in library first", icon=":material/close:")
 
@@ -154,6 +198,6 @@ st.sidebar.text(f"You can select which documents to embed by selecting from Embe
 st.sidebar.text("")
 st.sidebar.text(f"Based on your requirements or how the AI is behaving you can select which model to use for conversation from model preferences.")
 st.sidebar.text("")
-st.sidebar.text(f"While embedding a set of documents, you can also select which embedding model to use, because certain language models work better with some specific embedding models. Currently only one embedding model is available.")
+st.sidebar.text(f"While embedding a set of documents, you can also select which embedding model to use, because certain language models work better with some specific embedding models. Every embedding model keeps its own context, switching back to a model whose context was built already needs no re-embedding.")
 st.sidebar.text("")
 st.sidebar.text(f"If you want your language model to behave in a certain way, you can also do that by selecting the persona of the model from model persona preferences.")
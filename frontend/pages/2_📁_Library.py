@@ -32,6 +32,9 @@ if "messages" not in st.session_state:
 if "session_id" not in st.session_state:
     st.session_state.session_id = None
 
+if "doc_ids" not in st.session_state:
+    st.session_state.doc_ids = None
+
 
 
 #------------------- UPLOADED DOCUMENTS -----------------------------#
@@ -61,7 +64,9 @@ if documents:
         current_doc = {
             'ID': str(doc['id']),
             'Name' : str(doc['name']),
-            'Status' : "Embedded" if doc['is_active'] else "Not Embedded",
+            'Status' : "Active" if doc['is_active'] else "Not Active",
+            'Ingestion' : str(doc.get('ingestion_state', 'pending')).capitalize(),
+            'Chunks' : doc.get('chunk_count', 0),
             'Uploaded' : formatted_timestamp
         }
         formated_docs.append(current_doc)
@@ -96,13 +101,18 @@ if added_files:
     if st.button("Upload All"):
         with st.spinner("Uploading documents..."):
             
-            success = 0
-            for file in added_files:
-                upload_response = doc_api.upload(file)
-                
-                if upload_response:
-                    success += 1
-                    
+            # all files go in one request, stored in one transaction and ingested by one job
+            upload_response = doc_api.upload_batch(added_files)
+            items = upload_response['items'] if upload_response else []
+
+            for item in items:
+                if not item['success']:
+                    st.error(f"{item['filename']} : {item['message']}")
+                elif item['duplicate']:
+                    st.warning(item['message'])
+
+            success = sum(1 for item in items if item['success'])
+
             if success == len(added_files):
                 st.success(f"All files were uploaded Successfully")
             
@@ -111,7 +121,7 @@ if added_files:
 
             # Refresh document list from backend
             st.session_state.documents = doc_api.list_all()
-            st.info("Refresh Document list after uploading new files", icon=":material/exclamation:")
+            st.info("Uploaded files are parsed and embedded in the background, refresh Document list to follow their ingestion", icon=":material/exclamation:")
 
 # Panel Ended
 st.divider() 
@@ -143,15 +153,16 @@ if documents:
     if delete:
         with st.spinner("Deleting..."):
             
-            responses = []
-            success = 0 
+            # selected documents are deleted in one request and one transaction
+            delete_response = doc_api.delete_batch([doc['id'] for doc in selected_docs])
+            items = delete_response['items'] if delete_response else []
+
+            for item in items:
+                if not item['success']:
+                    st.error(item['message'])
+
+            success = sum(1 for item in items if item['success'])
 
-            for doc in selected_docs:
-                delete_response = doc_api.delete(doc['id'])
-            
-                if delete_response:
-                    success += 1    
-                    
             if success == len(selected_docs):
                 st.success(f"All Documents deleted successfully.")
             